@@ -1,10 +1,12 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import calendar
+import hashlib
+import heapq
+import itertools
 import logging
 
-from flask import Flask, abort, jsonify, render_template, request
+from flask import Flask, Response, abort, jsonify, render_template, request, stream_with_context
 from flask.json import JSONEncoder
 from flask_compress import Compress
 from datetime import datetime
@@ -12,9 +14,13 @@ from s2sphere import LatLng
 from pogom.utils import get_args
 from datetime import timedelta
 from collections import OrderedDict
+from queue import Empty
 
 from . import config
-from .models import Pokemon, Gym, Pokestop, ScannedLocation, MainWorker, WorkerStatus
+from .serialize import convert, gzip_chunks, iter_json, millis, to_millis
+from .models import Pokemon, Gym, Pokestop, ScannedLocation, MainWorker, WorkerStatus, active_pokemon, change_log, \
+    db_updater_stats, db_cleaner, db_connections, db_replicas, tile_cache
+from .spatial import bounds_difference, in_bounds
 from .utils import now
 log = logging.getLogger(__name__)
 compress = Compress()
@@ -36,6 +42,15 @@ class Pogom(Flask):
         self.route("/status", methods=['GET'])(self.get_status)
         self.route("/status", methods=['POST'])(self.post_status)
         self.route("/gym_data", methods=['GET'])(self.get_gymdata)
+        self.route("/stream", methods=['GET'])(self.stream)
+        self.push = None
+        # Reads of web requests go to a replica, if one is close enough.
+        self.before_request(db_replicas.begin)
+        self.teardown_request(db_replicas.end)
+        # Versions only count this process' writes, so they can only be
+        # trusted if it is the one writing, and the only one.
+        args = get_args()
+        self.etags = not args.only_server and not args.disable_memory_index
 
     def set_search_control(self, control):
         self.search_control = control
@@ -49,6 +64,9 @@ class Pogom(Flask):
     def set_current_location(self, location):
         self.current_location = location
 
+    def set_push_channel(self, push):
+        self.push = push
+
     def get_search_control(self):
         return jsonify({'status': not self.search_control.is_set()})
 
@@ -83,7 +101,8 @@ class Pogom(Flask):
                                lang=config['LOCALE'],
                                is_fixed=fixed_display,
                                search_control=search_display,
-                               show_scan=scan_display
+                               show_scan=scan_display,
+                               push_updates=self.push is not None
                                )
 
     def raw_data(self):
@@ -91,10 +110,20 @@ class Pogom(Flask):
         args = get_args()
         if args.on_demand_timeout > 0:
             self.search_control.clear()
+
+        etag = self.raw_data_etag()
+        if etag is not None and etag in request.if_none_match:
+            return self.not_modified(etag)
+        if etag is not None or change_log.enabled:
+            # ETags and sequence numbers stand for everything written so
+            # far; a replica's answer may lack some of it.
+            db_replicas.end()
+
         d = {}
 
-        # Request time of this request.
-        d['timestamp'] = datetime.utcnow()
+        # Request time of this request, as far as what we read goes. Off a
+        # replica the next request has to cover what it hadn't got yet.
+        d['timestamp'] = datetime.utcnow() - timedelta(seconds=db_replicas.staleness())
 
         # Request time of previous request.
         if request.args.get('timestamp'):
@@ -155,54 +184,129 @@ class Pogom(Flask):
         d['oNeLat'] = neLat
         d['oNeLng'] = neLng
 
+        # Changes since the last sequence number the client has seen, when we
+        # keep a change log. Falls back to the timestamp queries otherwise.
+        changes = None
+        if change_log.enabled:
+            bounds = None
+            if swLat and swLng and neLat and neLng:
+                bounds = (float(swLat), float(swLng), float(neLat), float(neLng))
+            if request.args.get('seq'):
+                d['seq'], changes = change_log.since(int(request.args.get('seq')), bounds)
+            else:
+                d['seq'] = change_log.seq
+
+        # Without bounds every active Pokemon goes out; those are streamed
+        # straight from the query instead of being collected first.
+        full_dump = (not (swLat and swLng and neLat and neLng) and
+                     request.args.get('format') != 'columnar')
+
+        # Everything in view, or only what the move uncovered. Served from
+        # the tiles shared by all clients when possible.
+        old_bounds = dict(oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng)
+
+        def pokemon_in_view(uncovered=False):
+            rows = None
+            if not active_pokemon.ready:
+                now = datetime.utcnow()
+                rows = self.from_tiles('pokemon', None, lambda b: Pokemon.get_active(*b),
+                                       lambda p: p['disappear_time'] > now, uncovered)
+            if rows is None:
+                rows = Pokemon.get_active(swLat, swLng, neLat, neLng, **(old_bounds if uncovered else {}))
+            return rows
+
+        def stops_in_view(uncovered=False):
+            rows = self.from_tiles('pokestop', luredonly, lambda b: Pokestop.get_stops(*b, lured=luredonly),
+                                   None, uncovered)
+            if rows is None:
+                rows = Pokestop.get_stops(swLat, swLng, neLat, neLng, lured=luredonly,
+                                          **(old_bounds if uncovered else {}))
+            return rows
+
+        def gyms_in_view(uncovered=False):
+            rows = self.from_tiles('gym', None, lambda b: Gym.get_gyms(*b).values(), None, uncovered)
+            if rows is None:
+                return Gym.get_gyms(swLat, swLng, neLat, neLng, **(old_bounds if uncovered else {}))
+            return dict((g['gym_id'], g) for g in rows)
+
+        def scanned_in_view(uncovered=False):
+            active = datetime.utcnow() - timedelta(minutes=15)
+            rows = self.from_tiles('scanned', None, lambda b: ScannedLocation.get_recent(*b),
+                                   lambda s: s['last_modified'] >= active, uncovered)
+            if rows is None:
+                return ScannedLocation.get_recent(swLat, swLng, neLat, neLng, **(old_bounds if uncovered else {}))
+            return sorted(rows, key=lambda s: s['last_modified'])
+
         if request.args.get('pokemon', 'true') == 'true':
             if request.args.get('ids'):
                 ids = [int(x) for x in request.args.get('ids').split(',')]
                 d['pokemons'] = Pokemon.get_active_by_id(ids, swLat, swLng,
                                                          neLat, neLng)
+            elif full_dump and changes is None:
+                d['pokemons'] = Pokemon.iter_active()
             elif lastpokemon != 'true':
                 # If this is first request since switch on, load all pokemon on screen.
-                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng)
+                d['pokemons'] = pokemon_in_view()
+            elif changes is not None:
+                # If map is already populated only send Pokemon written since the client's sequence number.
+                d['pokemons'] = Pokemon.get_changed(changes.get('pokemon', []))
+                if newArea:
+                    d['pokemons'] = d['pokemons'] + pokemon_in_view(uncovered=True)
             else:
                 # If map is already populated only request modified Pokemon since last request time.
                 d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng, timestamp=timestamp)
                 if newArea:
                     # If screen is moved add newly uncovered Pokemon to the ones that were modified since last request time.
-                    d['pokemons'] = d['pokemons'] + (Pokemon.get_active(swLat, swLng, neLat, neLng, oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng))
+                    d['pokemons'] = d['pokemons'] + pokemon_in_view(uncovered=True)
 
             if request.args.get('eids'):
                 # Exclude id's of pokemon that are hidden.
                 eids = [int(x) for x in request.args.get('eids').split(',')]
-                d['pokemons'] = [x for x in d['pokemons'] if x['pokemon_id'] not in eids]
+                d['pokemons'] = (x for x in d['pokemons'] if x['pokemon_id'] not in eids)
 
             if request.args.get('reids'):
                 reids = [int(x) for x in request.args.get('reids').split(',')]
-                d['pokemons'] = d['pokemons'] + (Pokemon.get_active_by_id(reids, swLat, swLng, neLat, neLng))
+                d['pokemons'] = itertools.chain(d['pokemons'], Pokemon.get_active_by_id(reids, swLat, swLng, neLat, neLng))
                 d['reids'] = reids
 
+            if not isinstance(d['pokemons'], list) and not full_dump:
+                d['pokemons'] = list(d['pokemons'])
+
         if request.args.get('pokestops', 'true') == 'true':
             if lastpokestops != 'true':
-                d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng, lured=luredonly)
+                d['pokestops'] = stops_in_view()
+            elif changes is not None:
+                d['pokestops'] = Pokestop.get_changed(changes.get('pokestop', []))
+                if newArea:
+                    d['pokestops'] = d['pokestops'] + stops_in_view(uncovered=True)
             else:
                 d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng, timestamp=timestamp)
                 if newArea:
-                    d['pokestops'] = d['pokestops'] + (Pokestop.get_stops(swLat, swLng, neLat, neLng, oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng, lured=luredonly))
+                    d['pokestops'] = d['pokestops'] + stops_in_view(uncovered=True)
 
         if request.args.get('gyms', 'true') == 'true':
             if lastgyms != 'true':
-                d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng)
+                d['gyms'] = gyms_in_view()
+            elif changes is not None:
+                d['gyms'] = Gym.get_gyms_by_id([g['gym_id'] for g in changes.get('gym', [])])
+                if newArea:
+                    d['gyms'].update(gyms_in_view(uncovered=True))
             else:
                 d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng, timestamp=timestamp)
                 if newArea:
-                    d['gyms'].update(Gym.get_gyms(swLat, swLng, neLat, neLng, oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng))
+                    d['gyms'].update(gyms_in_view(uncovered=True))
 
         if request.args.get('scanned', 'true') == 'true':
             if lastslocs != 'true':
-                d['scanned'] = ScannedLocation.get_recent(swLat, swLng, neLat, neLng)
+                d['scanned'] = scanned_in_view()
+            elif changes is not None:
+                d['scanned'] = ScannedLocation.get_changed(changes.get('scanned', []))
+                if newArea:
+                    d['scanned'] = d['scanned'] + scanned_in_view(uncovered=True)
             else:
                 d['scanned'] = ScannedLocation.get_recent(swLat, swLng, neLat, neLng, timestamp=timestamp)
                 if newArea:
-                    d['scanned'] = d['scanned'] + (ScannedLocation.get_recent(swLat, swLng, neLat, neLng, oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng))
+                    d['scanned'] = d['scanned'] + scanned_in_view(uncovered=True)
 
         selected_duration = None
 
@@ -239,7 +343,134 @@ class Pogom(Flask):
             elif request.args.get('password', None) == args.status_page_password:
                 d['main_workers'] = MainWorker.get_all()
                 d['workers'] = WorkerStatus.get_all()
-        return jsonify(d)
+
+        if request.args.get('format') == 'columnar':
+            for key, skip in columnar_layers.items():
+                if key in d:
+                    rows = d[key].values() if isinstance(d[key], dict) else d[key]
+                    d[key] = to_columns(rows, skip)
+
+        response = self.json_response(d)
+        if etag is not None:
+            response.set_etag(etag)
+        return response
+
+    def raw_data_etag(self):
+        '''
+        Version of what raw_data would answer: the request minus its
+        position in the client's polling, and the write counts of the
+        requested layers in view. Unchanged means the client already has it
+        all, so it is computed before anything is queried.
+        '''
+        if not self.etags:
+            return None
+        if any(request.args.get(k) == 'true' for k in ('seen', 'appearances', 'appearancesDetails', 'status')):
+            return None
+
+        bounds = None
+        try:
+            bounds = tuple(float(request.args[k]) for k in ('swLat', 'swLng', 'neLat', 'neLng'))
+        except (KeyError, ValueError):
+            pass
+        layers = [layer for arg, default, layer in etag_layers if request.args.get(arg, default) == 'true']
+        query = sorted((k, v) for k, v in request.args.items(True) if k not in ('timestamp', 'seq', '_'))
+        return self.etag(layers, bounds, query)
+
+    def etag(self, layers, bounds, extra):
+        versions = [tile_cache.version(layer, bounds) for layer in layers]
+        return hashlib.sha1(repr((extra, versions))).hexdigest()[:20]
+
+    def not_modified(self, etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    def from_tiles(self, layer, variant, load, keep, uncovered):
+        '''
+        Rows of a layer in the requested viewport, minus the previous one if
+        `uncovered`, put together from the cached tiles. Returns None if the
+        tile cache can't answer; the caller queries the database then.
+        '''
+        names = ('swLat', 'swLng', 'neLat', 'neLng')
+        try:
+            bounds = tuple(float(request.args[k]) for k in names)
+            exclude = tuple(float(request.args['o' + k[0].upper() + k[1:]]) for k in names) if uncovered else None
+        except (KeyError, ValueError):
+            return None
+        tiles = tile_cache.tiles(bounds)
+        if tiles is None:
+            return None
+        if exclude is not None:
+            # Only the tiles touching what the move uncovered.
+            tiles = sorted(set(t for rect in bounds_difference(bounds, exclude)
+                               for t in tile_cache.cover(rect)))
+
+        rows = []
+        # Tiles are kept and shared; loaded off a replica they could stay
+        # behind until the next write.
+        with db_replicas.primary():
+            tiles = [(tile, tile_cache.get(layer, variant, tile, load)) for tile in tiles]
+        for tile, tile_rows in tiles:
+            for row in tile_rows:
+                if not in_bounds(row['latitude'], row['longitude'], bounds):
+                    continue
+                if exclude is not None and in_bounds(row['latitude'], row['longitude'], exclude):
+                    continue
+                if keep is not None and not keep(row):
+                    continue
+                # Shared with other requests, which must not see this one's changes.
+                rows.append(dict(row))
+        return rows
+
+    def json_response(self, d):
+        return self.streamed(iter_json(convert(d)), 'application/json')
+
+    def stream_template(self, template_name, **context):
+        self.update_template_context(context)
+        template = self.jinja_env.get_template(template_name)
+        return self.streamed(template.generate(context), 'text/html')
+
+    def streamed(self, chunks, mimetype):
+        # Encoded (and compressed) as it is sent rather than as a whole. The
+        # request context, and with it the database connection, stays open
+        # until the last chunk.
+        response = Response(mimetype=mimetype)
+        if 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+            chunks = gzip_chunks(chunks, self.config.get('COMPRESS_LEVEL', 6))
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+        response.response = stream_with_context(chunks)
+        return response
+
+    def stream(self):
+        if self.push is None:
+            abort(404)
+
+        bounds = None
+        if all(request.args.get(k) for k in ('swLat', 'swLng', 'neLat', 'neLng')):
+            bounds = (request.args.get('swLat', type=float), request.args.get('swLng', type=float),
+                      request.args.get('neLat', type=float), request.args.get('neLng', type=float))
+
+        push = self.push
+        sub = push.subscribe(bounds)
+
+        def events():
+            try:
+                while True:
+                    try:
+                        kind, data = sub.queue.get(timeout=15)
+                    except Empty:
+                        # Keeps proxies from closing the connection, and lets us notice when the client went away.
+                        yield ': keep-alive\n\n'
+                        continue
+                    yield 'event: {}\ndata: {}\n\n'.format(kind, data)
+            finally:
+                push.unsubscribe(sub)
+
+        response = Response(events(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
 
     def loc(self):
         d = {}
@@ -273,14 +504,13 @@ class Pogom(Flask):
     def list_pokemon(self):
         # todo: Check if client is Android/iOS/Desktop for geolink, currently
         # only supports Android.
-        pokemon_list = []
 
         # Allow client to specify location.
         lat = request.args.get('lat', self.current_location[0], type=float)
         lon = request.args.get('lon', self.current_location[1], type=float)
         origin_point = LatLng.from_degrees(lat, lon)
 
-        for pokemon in Pokemon.get_active(None, None, None, None):
+        def entry(pokemon):
             pokemon_point = LatLng.from_degrees(pokemon['latitude'],
                                                 pokemon['longitude'])
             diff = pokemon_point - origin_point
@@ -290,7 +520,7 @@ class Pogom(Flask):
                          if abs(diff_lat) > 1e-4 else '') +\
                         (('E' if diff_lng >= 0 else 'W')
                          if abs(diff_lng) > 1e-4 else '')
-            entry = {
+            return {
                 'id': pokemon['pokemon_id'],
                 'name': pokemon['pokemon_name'],
                 'card_dir': direction,
@@ -303,12 +533,18 @@ class Pogom(Flask):
                 'latitude': pokemon['latitude'],
                 'longitude': pokemon['longitude']
             }
-            pokemon_list.append((entry, entry['distance']))
-        pokemon_list = [y[0] for y in sorted(pokemon_list, key=lambda x: x[1])]
-        return render_template('mobile_list.html',
-                               pokemon_list=pokemon_list,
-                               origin_lat=lat,
-                               origin_lng=lon)
+
+        def nearest():
+            # The page lists the closest 20, so that's all that is kept while
+            # going through the active Pokemon.
+            for e in heapq.nsmallest(20, itertools.imap(entry, Pokemon.iter_active()),
+                                     key=lambda e: e['distance']):
+                yield e
+
+        return self.stream_template('mobile_list.html',
+                                    pokemon_list=nearest(),
+                                    origin_lat=lat,
+                                    origin_lng=lon)
 
     def get_valid_stat_input(self):
         duration = request.args.get("duration", type=str)
@@ -356,9 +592,20 @@ class Pogom(Flask):
 
     def get_gymdata(self):
         gym_id = request.args.get('id')
+
+        # Gym details don't say where they are, any gym write counts.
+        etag = self.etag(['gym'], None, gym_id) if self.etags else None
+        if etag is not None and etag in request.if_none_match:
+            return self.not_modified(etag)
+        if etag is not None:
+            db_replicas.end()
+
         gym = Gym.get_gym(gym_id)
 
-        return jsonify(gym)
+        response = jsonify(gym)
+        if etag is not None:
+            response.set_etag(etag)
+        return response
 
     def get_status(self):
         args = get_args()
@@ -377,23 +624,61 @@ class Pogom(Flask):
             d['login'] = 'ok'
             d['main_workers'] = MainWorker.get_all()
             d['workers'] = WorkerStatus.get_all()
+            d['db_updater'] = db_updater_stats.snapshot()
+            d['db_cleaner'] = db_cleaner.snapshot()
+            d['db_connections'] = db_connections.snapshot()
+            d['db_replicas'] = db_replicas.snapshot()
         else:
             d['login'] = 'failed'
         return jsonify(d)
 
 
+# Layer switches of raw_data, their defaults and the tile cache layers they cover.
+etag_layers = (
+    ('pokemon', 'true', 'pokemon'),
+    ('pokestops', 'true', 'pokestop'),
+    ('gyms', 'true', 'gym'),
+    ('scanned', 'true', 'scanned'),
+    ('spawnpoints', 'false', 'spawnpoint'),
+)
+
+# Layers of raw_data that can be sent as columns, with the fields the
+# client looks up in its own copy of pokemon.json instead.
+columnar_layers = {
+    'pokemons': ('pokemon_name', 'pokemon_rarity', 'pokemon_types'),
+    'pokestops': (),
+    'gyms': (),
+    'scanned': (),
+    'spawnpoints': (),
+}
+
+
+def to_columns(rows, skip=()):
+    '''
+    Turns a list of dicts into a dict of equally long lists, one per field,
+    leaving out the `skip` fields. Datetime columns are converted to epoch
+    milliseconds as a whole here rather than one by one by the JSON encoder.
+    '''
+    fields = set()
+    for row in rows:
+        fields.update(row)
+    fields.difference_update(skip)
+
+    columns = {}
+    for field in fields:
+        column = [row.get(field) for row in rows]
+        if any(isinstance(v, datetime) for v in column):
+            column = millis(column)
+        columns[field] = column
+    return columns
+
+
 class CustomJSONEncoder(JSONEncoder):
 
     def default(self, obj):
         try:
             if isinstance(obj, datetime):
-                if obj.utcoffset() is not None:
-                    obj = obj - obj.utcoffset()
-                millis = int(
-                    calendar.timegm(obj.timetuple()) * 1000 +
-                    obj.microsecond / 1000
-                )
-                return millis
+                return to_millis(obj)
             iterable = iter(obj)
         except TypeError:
             pass
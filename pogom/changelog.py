@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from bisect import bisect_right
+from threading import Lock
+
+from .spatial import in_bounds
+
+log = logging.getLogger(__name__)
+
+
+class ChangeLog(object):
+    '''
+    Numbers every row written for the map layers with a monotonically
+    increasing sequence number and keeps the most recent ones around.
+
+    Sequence numbers are handed out after the write went through, so a
+    client that has seen everything up to N can ask for "everything after N"
+    without an overlap window and without missing rows that parallel
+    db_updater threads committed out of order.
+
+    Numbering starts at the current time in ms so sequence numbers a client
+    kept from before a restart are older than anything in the new log.
+    '''
+
+    def __init__(self, size=20000):
+        self.size = size
+        self.seq = int(time.time() * 1000)
+        self.seqs = []
+        self.entries = []
+        self.lock = Lock()
+        self.enabled = False
+
+    def enable(self):
+        self.enabled = True
+
+    def append(self, kind, key_fields, rows):
+        with self.lock:
+            for row in rows:
+                self.seq += 1
+                self.seqs.append(self.seq)
+                self.entries.append((kind, tuple(row[f] for f in key_fields), row))
+
+            # Trim in chunks rather than on every append.
+            if len(self.seqs) > self.size * 5 / 4:
+                excess = len(self.seqs) - self.size
+                del self.seqs[:excess]
+                del self.entries[:excess]
+
+    def since(self, seq, bounds=None):
+        '''
+        Returns (head, changes) where changes maps each kind to the latest
+        version of every row written after seq, limited to bounds when given.
+        Returns (head, None) if seq fell out of the log; the caller has to
+        fall back to a full query in that case.
+        '''
+        with self.lock:
+            head = self.seq
+            oldest = self.seqs[0] if self.seqs else head + 1
+            if seq > head or seq < oldest - 1:
+                return head, None
+            entries = self.entries[bisect_right(self.seqs, seq):]
+
+        changes = {}
+        for kind, key, row in entries:
+            if bounds is not None and not in_bounds(row['latitude'], row['longitude'], bounds):
+                continue
+            # Later writes of the same row replace earlier ones.
+            changes.setdefault(kind, {})[key] = row
+
+        return head, dict((kind, rows.values()) for kind, rows in changes.items())
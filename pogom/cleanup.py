@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from threading import Lock
+
+from peewee import fn
+
+log = logging.getLogger(__name__)
+
+
+class BatchCleaner(object):
+    '''
+    Expires rows a bounded batch at a time instead of in one statement over
+    everything, so no cleaning statement holds its locks for long.
+
+    Batches are ranges of the indexed column rows expire by, oldest first.
+    The batch size adapts to keep each batch around `target` seconds, and
+    after every batch the cleaner pauses for as long as it took, or as long
+    as the db updater's last write took if that was slower, so writes
+    always get their turn.
+    '''
+
+    def __init__(self, batch=1000, min_batch=100, max_batch=10000, target=0.25, max_pause=5.0, latency=None):
+        self.batch = batch
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.target = target
+        self.max_pause = max_pause
+        # Seconds the last write of the db updater took.
+        self.latency = latency or (lambda: 0.0)
+        self.lock = Lock()
+        self.rows = 0
+        self.seconds = 0.0
+        self.last = {}
+
+    def expire(self, name, column, cutoff, change, where=None):
+        '''
+        Applies change(condition), a delete or update returning the number
+        of rows it touched, to the rows whose `column` is before `cutoff`
+        (and that match `where`, if given). Returns that number.
+        '''
+        model = column.model_class
+        # Cheap on an indexed column; most of the time nothing expired.
+        first = self._value(self._where(model.select(fn.MIN(column)), where))
+        if first is None or first >= cutoff:
+            return 0
+
+        rows = 0
+        started = time.time()
+        while True:
+            first = self._value(self._where(model.select(fn.MIN(column)).where(column < cutoff), where))
+            if first is None:
+                break
+            # Up to the first one left for the next batch.
+            end = self._value(self._where(model.select(column).where(column < cutoff), where)
+                              .order_by(column)
+                              .limit(1)
+                              .offset(self.batch))
+            if end is None:
+                condition = column < cutoff
+            elif end > first:
+                condition = (column >= first) & (column < end)
+            else:
+                condition = column == first
+            if where is not None:
+                condition &= where
+
+            batch_started = time.time()
+            rows += change(condition)
+            elapsed = time.time() - batch_started
+            self._adapt(elapsed)
+            if end is None:
+                break
+            time.sleep(min(max(elapsed, self.latency()), self.max_pause))
+
+        self._record(name, rows, time.time() - started)
+        return rows
+
+    @staticmethod
+    def _where(query, where):
+        return query.where(where) if where is not None else query
+
+    @staticmethod
+    def _value(query):
+        # Unlike scalar(), converted to the column's type.
+        row = query.tuples().first()
+        return row[0] if row else None
+
+    def _adapt(self, elapsed):
+        if elapsed > self.target:
+            self.batch = max(self.min_batch, self.batch // 2)
+        elif elapsed < self.target / 2:
+            self.batch = min(self.max_batch, self.batch * 2)
+
+    def _record(self, name, rows, seconds):
+        with self.lock:
+            self.rows += rows
+            self.seconds += seconds
+            self.last[name] = {
+                'rows': rows,
+                'ms': int(seconds * 1000),
+                'rows_per_sec': int(rows / seconds) if seconds else 0,
+            }
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'rows': self.rows,
+                'rows_per_sec': int(self.rows / self.seconds) if self.seconds else 0,
+                'batch': self.batch,
+                'last': dict(self.last),
+            }
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Condition, Lock, local
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionManager(object):
+    '''
+    Which threads get which database connections.
+
+    The db updaters keep one connection each for good. Search workers, one
+    per account, only borrow one from a small shared pool of readers for
+    the queries they run and hand it back right after, so the number of
+    connections doesn't grow with the account list. Time spent waiting for
+    a reader or for the pool is measured.
+    '''
+
+    def __init__(self):
+        self.db = None
+        self.readers = None
+        self.lock = Lock()
+        # Whether the thread has a connection of its own or is already reading.
+        self.local = local()
+        # kind: [waits, seconds waited, longest wait]
+        self.waits = {}
+
+    def init(self, db, readers):
+        self.db = db
+        self.readers = BoundedSemaphore(readers)
+
+    def dedicated(self):
+        # For the threads that keep their connection for good.
+        self.local.owned = True
+
+    @contextmanager
+    def reading(self):
+        # A connection for the duration, from the shared readers.
+        if self.db is None or getattr(self.local, 'owned', False):
+            yield
+            return
+
+        started = time.time()
+        with self.readers:
+            self.waited('read', time.time() - started)
+            self.local.owned = True
+            try:
+                # One a query outside of reading() opened is used, and given back, too.
+                if self.db.is_closed():
+                    self.db.connect()
+                yield
+            finally:
+                self.local.owned = False
+                if not self.db.is_closed():
+                    self.db.close()
+
+    def waited(self, kind, seconds):
+        with self.lock:
+            waits = self.waits.setdefault(kind, [0, 0.0, 0.0])
+            waits[0] += 1
+            waits[1] += seconds
+            waits[2] = max(waits[2], seconds)
+
+    def snapshot(self):
+        with self.lock:
+            d = dict((kind, {'waits': n, 'avg_ms': int(total * 1000 / n) if n else 0, 'max_ms': int(longest * 1000)})
+                     for kind, (n, total, longest) in self.waits.items())
+        pool = getattr(self.db, '_in_use', None)
+        if pool is not None:
+            d['in_use'] = len(pool)
+            d['idle'] = len(self.db._connections)
+            d['max_connections'] = self.db.max_connections
+        return d
+
+
+class WaitingPool(object):
+    '''
+    For playhouse's pooled databases: when all `max_connections` are out,
+    wait up to `wait_timeout` seconds for one to come back instead of
+    failing right away.
+    '''
+
+    wait_timeout = 30
+
+    def __init__(self, *args, **kwargs):
+        self.returned = Condition(Lock())
+        self.manager = kwargs.pop('manager', None)
+        super(WaitingPool, self).__init__(*args, **kwargs)
+
+    def connect(self):
+        started = time.time()
+        while True:
+            try:
+                super(WaitingPool, self).connect()
+                break
+            except ValueError:
+                # The pool is exhausted.
+                if time.time() - started > self.wait_timeout:
+                    log.error('No database connection came free within %d seconds', self.wait_timeout)
+                    raise
+                with self.returned:
+                    self.returned.wait(0.1)
+        if self.manager is not None:
+            self.manager.waited('pool', time.time() - started)
+
+    def close(self):
+        super(WaitingPool, self).close()
+        with self.returned:
+            self.returned.notify()
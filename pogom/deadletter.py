@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+
+from datetime import datetime
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+def dump_rows(rows):
+    # Datetimes don't survive JSON on their own, tag them so they can be restored.
+    return [dict((k, {'$dt': v.isoformat()} if isinstance(v, datetime) else v)
+                 for k, v in row.items()) for row in rows]
+
+
+def load_rows(rows):
+    return [dict((k, _load_value(v)) for k, v in row.items()) for row in rows]
+
+
+def _load_value(value):
+    if isinstance(value, dict) and '$dt' in value:
+        iso = value['$dt']
+        fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in iso else '%Y-%m-%dT%H:%M:%S'
+        return datetime.strptime(iso, fmt)
+    return value
+
+
+class DeadLetters(object):
+    '''
+    Append-only JSON lines file for rows the database refused to take, one
+    line per model and chunk, so they can be looked at and replayed later.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+
+    def write(self, model_name, rows, error):
+        line = json.dumps({
+            'model': model_name,
+            'time': datetime.utcnow().isoformat(),
+            'error': str(error),
+            'rows': dump_rows(rows),
+        })
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+    def replay(self, upsert):
+        '''
+        Moves the current file aside and hands every entry to
+        upsert(model_name, rows). Rows that fail again end up in a fresh file
+        through the usual path. Returns the number of rows replayed.
+        '''
+        with self.lock:
+            if not os.path.isfile(self.path):
+                return 0
+            replay_path = self.path + '.replay'
+            os.rename(self.path, replay_path)
+
+        count = 0
+        with open(replay_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                    rows = load_rows(entry['rows'])
+                except (ValueError, KeyError) as e:
+                    log.warning('Skipping unreadable dead letter: %s', e)
+                    continue
+                upsert(entry['model'], rows)
+                count += len(rows)
+
+        os.remove(replay_path)
+        return count
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from threading import Lock
+from queue import Queue, Full, Empty
+
+log = logging.getLogger(__name__)
+
+
+class MapEvent(object):
+    '''
+    Something a search worker saw on the map. `row` is the database row and
+    the only dict built for it; subscribers derive their own formats from it
+    in their own threads and must not modify it.
+    '''
+
+    __slots__ = ('row', 'timestamp_ms')
+    kind = None
+
+    def __init__(self, row, timestamp_ms=None):
+        self.row = row
+        self.timestamp_ms = timestamp_ms
+
+
+class PokemonSeen(MapEvent):
+    __slots__ = ('time_until_hidden_ms',)
+    kind = 'pokemon'
+
+    def __init__(self, row, timestamp_ms, time_until_hidden_ms):
+        super(PokemonSeen, self).__init__(row, timestamp_ms)
+        self.time_until_hidden_ms = time_until_hidden_ms
+
+
+class PokestopSeen(MapEvent):
+    __slots__ = ('changed',)
+    kind = 'pokestop'
+
+    def __init__(self, row, timestamp_ms, changed=True):
+        super(PokestopSeen, self).__init__(row, timestamp_ms)
+        # Unchanged stops are only published for the all-stops webhooks.
+        self.changed = changed
+
+
+class GymSeen(MapEvent):
+    __slots__ = ()
+    kind = 'gym'
+
+
+class LocationScanned(MapEvent):
+    __slots__ = ()
+    kind = 'scanned'
+
+
+class GymDetailsSeen(MapEvent):
+    # The webhook message itself; the details are written by parse_gyms.
+    __slots__ = ()
+    kind = 'gym_details'
+
+
+class EventBatch(list):
+    '''
+    The events of one map response, delivered to every subscriber as a whole.
+    '''
+    pass
+
+
+class Subscription(object):
+    '''
+    A subscriber's own bounded buffer. The policy decides what happens when
+    it is full: "block" waits for the consumer, "drop" discards the new batch
+    and "drop_oldest" discards the oldest queued item to make room.
+    '''
+
+    policies = ('block', 'drop', 'drop_oldest')
+
+    def __init__(self, name, maxsize, policy, kinds=None, queue=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown backpressure policy: {}'.format(policy))
+        self.name = name
+        self.policy = policy
+        self.kinds = frozenset(kinds) if kinds else None
+        self.queue = queue if queue is not None else Queue(maxsize)
+        self.dropped = 0
+
+    def offer(self, batch):
+        if self.kinds is not None:
+            batch = EventBatch(e for e in batch if e.kind in self.kinds)
+            if not batch:
+                return
+
+        if self.policy == 'block':
+            self.queue.put(batch)
+            return
+
+        try:
+            self.queue.put_nowait(batch)
+            return
+        except Full:
+            pass
+
+        if self.policy == 'drop_oldest':
+            # Each batch lost counts once: the oldest one, if it made room,
+            # and this one, if it still didn't fit.
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self._dropped()
+            except Empty:
+                pass
+            try:
+                self.queue.put_nowait(batch)
+                return
+            except Full:
+                pass
+        self._dropped()
+
+    def _dropped(self):
+        self.dropped += 1
+        if self.dropped % 100 == 1:
+            log.warning('%s subscriber is falling behind, %d batches dropped so far.',
+                        self.name, self.dropped)
+
+
+class EventBus(object):
+    '''
+    Fans the events parsed from each map response out to the subscribers
+    (database, webhooks, live map clients). Publishing never builds anything
+    per subscriber, and only a "block" subscriber can slow the publisher down.
+    '''
+
+    def __init__(self):
+        self.subscriptions = []
+        self.lock = Lock()
+
+    def subscribe(self, name, maxsize=0, policy='block', kinds=None, queue=None):
+        # A queue passed in brings its own maxsize.
+        sub = Subscription(name, maxsize, policy, kinds, queue)
+        with self.lock:
+            self.subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if sub in self.subscriptions:
+                self.subscriptions.remove(sub)
+
+    def publish(self, events):
+        if not events:
+            return
+        batch = EventBatch(events)
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for sub in subscriptions:
+            sub.offer(batch)
+
+
+event_bus = EventBus()
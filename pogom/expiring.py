@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+
+from datetime import datetime
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+class ExpiringSet(object):
+    '''
+    A set of keys that each drop out at their own expiry time. When it holds
+    `maxsize` keys the ones expiring soonest make room for new ones.
+
+    `warm` tells whether the set can be trusted to know about everything
+    that is still alive, e.g. after it was loaded from the database. It no
+    longer can once a key had to make room before it expired.
+    '''
+
+    def __init__(self, maxsize=200000):
+        self.maxsize = maxsize
+        self.expiry = {}
+        self.heap = []
+        self.lock = Lock()
+        self.warm = False
+
+    def __len__(self):
+        return len(self.expiry)
+
+    def load(self, items):
+        self.add_all(items)
+        self.warm = True
+
+    def add_all(self, items):
+        # items are (key, expires) pairs.
+        now = datetime.utcnow()
+        with self.lock:
+            for key, expires in items:
+                if expires <= now:
+                    continue
+                self.expiry[key] = expires
+                heapq.heappush(self.heap, (expires, key))
+            self._expire(now)
+
+    def known(self, keys):
+        # Returns the subset of keys that are in the set and not expired yet.
+        now = datetime.utcnow()
+        with self.lock:
+            return set(k for k in keys if self.expiry.get(k, now) > now)
+
+    def _expire(self, now):
+        while self.heap and (self.heap[0][0] <= now or len(self.expiry) > self.maxsize):
+            expires, key = heapq.heappop(self.heap)
+            # Only if the key wasn't re-added with a later expiry since.
+            if self.expiry.get(key) == expires:
+                del self.expiry[key]
+                if expires > now and self.warm:
+                    log.warning('More than %d keys alive, no longer trusting the set to know them all.', self.maxsize)
+                    self.warm = False
+
+        # Re-added keys leave stale heap entries behind; rebuild once they dominate.
+        if len(self.heap) > 2 * len(self.expiry) + 1000:
+            self.heap = [(e, k) for k, e in self.expiry.items()]
+            heapq.heapify(self.heap)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+
+from peewee import SQL
+
+log = logging.getLogger(__name__)
+
+
+class GeoIndex(object):
+    '''
+    A real two-dimensional index next to the (latitude, longitude) B-tree,
+    which only narrows a bounding box down by latitude.
+
+    SQLite gets an R*Tree virtual table per model, kept in sync by triggers
+    on every insert, replace, update and delete. MySQL (5.7.6 and later)
+    gets a stored POINT column computed from latitude and longitude, with a
+    SPATIAL INDEX on it. Where neither is available the plain bounding box
+    predicate is used as before.
+    '''
+
+    def __init__(self):
+        self.db_type = None
+        self.models = set()
+
+    def setup(self, db, db_type, models):
+        self.db_type = db_type
+        for model in models:
+            try:
+                if db_type == 'mysql':
+                    supported = self._setup_mysql(db, model)
+                else:
+                    supported = self._setup_sqlite(db, model)
+            except Exception as e:
+                log.warning('No spatial index for %s, using the latitude/longitude index: %s',
+                            model._meta.db_table, e)
+                continue
+            if supported:
+                self.models.add(model)
+
+    def drop(self, db, db_type, models):
+        self.models.clear()
+        if db_type == 'mysql':
+            # The column goes with its table.
+            return
+        for model in models:
+            db.execute_sql('DROP TABLE IF EXISTS {}'.format(self._rtree(model)))
+
+    def within(self, model, swLat, swLng, neLat, neLng):
+        '''
+        Filter for the rows of model in the bounding box. The index only
+        finds candidates; the exact comparison decides, so rounding in the
+        index (the R*Tree stores 32 bit floats) can't change the result.
+        '''
+        exact = ((model.latitude >= swLat) &
+                 (model.longitude >= swLng) &
+                 (model.latitude <= neLat) &
+                 (model.longitude <= neLng))
+        if model not in self.models:
+            return exact
+
+        if self.db_type == 'mysql':
+            return exact & SQL('MBRIntersects(ST_MakeEnvelope(Point(%s, %s), Point(%s, %s)), geo)',
+                               swLng, swLat, neLng, neLat)
+        return exact & SQL('rowid IN (SELECT id FROM {} WHERE max_lat >= ? AND min_lat <= ? AND '
+                           'max_lng >= ? AND min_lng <= ?)'.format(self._rtree(model)),
+                           swLat, neLat, swLng, neLng)
+
+    @staticmethod
+    def _rtree(model):
+        return model._meta.db_table + '_rtree'
+
+    def _setup_sqlite(self, db, model):
+        table = model._meta.db_table
+        rtree = self._rtree(model)
+        exists = db.execute_sql("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                (rtree,)).fetchone()
+
+        with db.atomic():
+            db.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING rtree(id, min_lat, max_lat, min_lng, max_lng)'
+                           .format(rtree))
+            # A REPLACE deletes the old row first; with recursive_triggers on
+            # (see init_database) that fires the delete trigger too.
+            db.execute_sql('CREATE TRIGGER IF NOT EXISTS {0}_insert AFTER INSERT ON {1} BEGIN '
+                           'INSERT OR REPLACE INTO {0} VALUES (new.rowid, new.latitude, new.latitude, '
+                           'new.longitude, new.longitude); END'.format(rtree, table))
+            db.execute_sql('CREATE TRIGGER IF NOT EXISTS {0}_update AFTER UPDATE OF latitude, longitude ON {1} BEGIN '
+                           'INSERT OR REPLACE INTO {0} VALUES (new.rowid, new.latitude, new.latitude, '
+                           'new.longitude, new.longitude); END'.format(rtree, table))
+            db.execute_sql('CREATE TRIGGER IF NOT EXISTS {0}_delete AFTER DELETE ON {1} BEGIN '
+                           'DELETE FROM {0} WHERE id = old.rowid; END'.format(rtree, table))
+            if not exists:
+                log.info('Building the spatial index of %s...', table)
+                db.execute_sql('INSERT OR REPLACE INTO {} SELECT rowid, latitude, latitude, longitude, longitude FROM {}'
+                               .format(rtree, table))
+        return True
+
+    def _setup_mysql(self, db, model):
+        version = db.execute_sql('SELECT VERSION()').fetchone()[0]
+        numbers = tuple(int(n) for n in re.findall(r'\d+', version)[:3])
+        if 'mariadb' in version.lower() or numbers < (5, 7, 6):
+            log.info('MySQL %s has no spatial indexes on computed columns, using the latitude/longitude index', version)
+            return False
+
+        table = model._meta.db_table
+        cursor = db.execute_sql("SELECT 1 FROM information_schema.columns WHERE table_schema = DATABASE() "
+                                "AND table_name = %s AND column_name = 'geo'", (table,))
+        if cursor.fetchone():
+            return True
+
+        # Without an SRID on the column MySQL 8 ignores the index.
+        srid = ' SRID 0' if numbers >= (8, 0, 0) else ''
+        log.info('Adding a spatial index to %s, this may take a while...', table)
+        db.execute_sql('ALTER TABLE `{}` ADD COLUMN geo POINT{} AS (Point(longitude, latitude)) STORED NOT NULL, '
+                       'ADD SPATIAL INDEX geo (geo)'.format(table, srid))
+        return True
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from datetime import date, datetime, timedelta
+from threading import Lock
+
+from peewee import fn
+
+log = logging.getLogger(__name__)
+
+
+class HistoryPartitions(object):
+    '''
+    Pokemon that despawned, moved out of the live table into one partition
+    per day they disappeared on. The live table only holds what is (about
+    to be) on the map, and purging drops whole days instead of deleting
+    rows one by one.
+
+    On MySQL the partitions are those of a table partitioned by day, on
+    SQLite they're a table per day in the same file. Pokemon with a
+    disappear time from the server are kept in a table of their own that is
+    never purged, as before.
+    '''
+
+    def __init__(self, model, db_type):
+        self.model = model
+        self.db_type = db_type
+        self.table = model._meta.db_table + 'history'
+        self.kept = self.table + '_kept'
+        self.models = {}
+        self.lock = Lock()
+
+    def setup(self, db):
+        self._model(self.kept).create_table(fail_silently=True)
+        if self.db_type != 'mysql':
+            return
+
+        if self.table in db.get_tables():
+            return
+        # A partition for every day there are Pokemon of in the live table so
+        # far, and today. Each also takes whatever is older, up to the one
+        # before it.
+        now = datetime.utcnow()
+        days = sorted(set(self._live_days(None, now)) | set([now.date()]))
+        partitions = [self._partition(day) for day in days]
+        # Partitioned tables need the partitioning column in their primary key.
+        self._model(self.table).create_table()
+        db.execute_sql('ALTER TABLE `{}` DROP PRIMARY KEY, ADD PRIMARY KEY (encounter_id, disappear_time) '
+                       'PARTITION BY RANGE (TO_DAYS(disappear_time)) ({})'
+                       .format(self.table, ', '.join(partitions)))
+
+    def drop(self, db):
+        for name in [self.table, self.kept] + [self._day_table(day) for day in self.days(db)]:
+            db.execute_sql('DROP TABLE IF EXISTS {}'.format(self._quote(db, name)))
+        self.models.clear()
+
+    def days(self, db):
+        # The days there are partitions for, oldest first.
+        if self.db_type == 'mysql':
+            cursor = db.execute_sql('SELECT partition_name FROM information_schema.partitions '
+                                    'WHERE table_schema = DATABASE() AND table_name = %s', (self.table,))
+            names = [row[0] for row in cursor.fetchall() if row[0]]
+            return sorted(datetime.strptime(name[1:], '%Y%m%d').date() for name in names)
+
+        prefix = self.table + '_'
+        days = []
+        for name in db.get_tables():
+            if not name.startswith(prefix):
+                continue
+            try:
+                days.append(datetime.strptime(name[len(prefix):], '%Y%m%d').date())
+            except ValueError:
+                continue
+        return sorted(days)
+
+    def models_since(self, db, since=None):
+        '''
+        The models to read Pokemon that disappeared after `since` (all of
+        them without it) from: the live table, the partitions and the kept.
+        '''
+        models = [self.model]
+        if self.db_type == 'mysql':
+            models.append(self._model(self.table))
+        else:
+            models.extend(self._model(self._day_table(day)) for day in self.days(db)
+                          if since is None or day >= since.date())
+        models.append(self._model(self.kept))
+        return models
+
+    def archive(self, db, before, batch=5000):
+        '''
+        Moves the Pokemon that disappeared before `before` out of the live
+        table, about `batch` of them per transaction, oldest first. Returns
+        how many that were.
+        '''
+        moved = 0
+        with self.lock:
+            if self.db_type == 'mysql':
+                # DDL, which would end the transaction.
+                self._add_partitions(db, before)
+
+            while True:
+                first = self._first(before)
+                if first is None:
+                    break
+                # Up to the disappear time of the first one left for the next batch.
+                end = self._first(before, offset=batch) or before
+                if end <= first:
+                    end = min(first + timedelta(seconds=1), before)
+                moved += self._move(db, first, end)
+        return moved
+
+    def purge(self, db, before):
+        '''
+        Drops the days that ended by `before`. Whole days only, so rows stay
+        up to a day longer than asked for.
+        '''
+        with self.lock:
+            days = [day for day in self.days(db) if day + timedelta(days=1) <= before.date()]
+            if not days:
+                return 0
+            if self.db_type == 'mysql':
+                # A partitioned table can't lose its last partition.
+                days = days[:len(self.days(db)) - 1]
+                if days:
+                    db.execute_sql('ALTER TABLE `{}` DROP PARTITION {}'.format(
+                        self.table, ', '.join('p' + day.strftime('%Y%m%d') for day in days)))
+            else:
+                for day in days:
+                    table = self._day_table(day)
+                    db.execute_sql('DROP TABLE IF EXISTS {}'.format(self._quote(db, table)))
+                    self.models.pop(table, None)
+        if days:
+            log.info('Purged the Pokemon history of %d day(s) up to %s', len(days), days[-1])
+        return len(days)
+
+    def _move(self, db, first, end):
+        live = self.model._meta.db_table
+        columns = ', '.join(self._quote(db, f.db_column) for f in self.model._meta.sorted_fields)
+        p = db.interpolation
+        with db.atomic():
+            self._copy(db, live, columns, self.kept, 'time_detail = 1', [end])
+            if self.db_type == 'mysql':
+                self._copy(db, live, columns, self.table, 'time_detail <> 1', [end])
+            else:
+                for day in self._live_days(first, end):
+                    start = datetime(day.year, day.month, day.day)
+                    table = self._day_table(day)
+                    self._model(table).create_table(fail_silently=True)
+                    self._copy(db, live, columns, table,
+                               'time_detail <> 1 AND disappear_time >= {0} AND disappear_time < {0}'.format(p),
+                               [end, start, start + timedelta(days=1)])
+            cursor = db.execute_sql('DELETE FROM {} WHERE disappear_time < {}'.format(self._quote(db, live), p),
+                                    (end,))
+        return cursor.rowcount
+
+    def _first(self, before, offset=0):
+        # When the first (after skipping `offset`) Pokemon in the live table
+        # that disappeared before `before` did.
+        first = (self.model
+                 .select(self.model.disappear_time)
+                 .where(self.model.disappear_time < before)
+                 .order_by(self.model.disappear_time)
+                 .limit(1)
+                 .offset(offset)
+                 .tuples()
+                 .first())
+        return first[0] if first else None
+
+    def _live_days(self, since, before):
+        # The days Pokemon in the live table that aren't kept disappeared on,
+        # from `since` (if given) up to `before`.
+        disappear_time = self.model.disappear_time
+        condition = (disappear_time < before) & (self.model.time_detail != 1)
+        if since is not None:
+            condition &= disappear_time >= since
+        query = (self.model
+                 .select(fn.DATE(disappear_time))
+                 .where(condition)
+                 .distinct()
+                 .tuples())
+        days = []
+        for day, in query:
+            # A string on SQLite.
+            if not isinstance(day, date):
+                day = datetime.strptime(str(day)[:10], '%Y-%m-%d').date()
+            days.append(day)
+        return sorted(days)
+
+    def _copy(self, db, live, columns, table, condition, params):
+        verb = 'REPLACE' if self.db_type == 'mysql' else 'INSERT OR REPLACE'
+        db.execute_sql('{0} INTO {1} ({2}) SELECT {2} FROM {3} WHERE disappear_time < {4} AND {5}'.format(
+            verb, self._quote(db, table), columns, self._quote(db, live), db.interpolation, condition), params)
+
+    def _add_partitions(self, db, before):
+        # For the days there are Pokemon to move of. Partitions can only be
+        # added after the newest one, which takes everything older.
+        days = self.days(db)
+        since = datetime.combine(days[-1] + timedelta(days=1), datetime.min.time()) if days else None
+        partitions = [self._partition(day) for day in self._live_days(since, before)]
+        if partitions:
+            db.execute_sql('ALTER TABLE `{}` ADD PARTITION ({})'.format(self.table, ', '.join(partitions)))
+
+    def _partition(self, day):
+        return "PARTITION p{} VALUES LESS THAN (TO_DAYS('{}'))".format(
+            day.strftime('%Y%m%d'), (day + timedelta(days=1)).isoformat())
+
+    def _day_table(self, day):
+        return '{}_{}'.format(self.table, day.strftime('%Y%m%d'))
+
+    def _model(self, table):
+        # The live model under another table name, to query the history with.
+        model = self.models.get(table)
+        if model is None:
+            meta = type('Meta', (object,), {'db_table': table})
+            model = type(str(table), (self.model,), {'Meta': meta, '__module__': __name__})
+            self.models[table] = model
+        return model
+
+    @staticmethod
+    def _quote(db, name):
+        return '{0}{1}{0}'.format(db.quote_char, name)
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from collections import deque
+from threading import Lock, Thread, local
+from queue import Queue
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+log = logging.getLogger(__name__)
+
+# Record header: payload length and crc32 of the payload. A zero length ends a segment.
+header = struct.Struct('<II')
+
+
+class Segment(object):
+
+    def __init__(self, path, size):
+        self.path = path
+        exists = os.path.isfile(path)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(size)
+        self.size = os.path.getsize(path)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.offset = 0
+        self.outstanding = 0
+        self.sealed = False
+        self.dirty = False
+
+    def fits(self, payload):
+        # Room for the record and the terminator behind it.
+        return self.offset + 2 * header.size + len(payload) <= self.size
+
+    def append(self, payload):
+        end = self.offset + header.size + len(payload)
+        self.map[self.offset:end] = header.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        self.map[end:end + header.size] = header.pack(0, 0)
+        self.offset = end
+        self.outstanding += 1
+        self.dirty = True
+
+    def rewind(self):
+        self.map[0:header.size] = header.pack(0, 0)
+        self.offset = 0
+        self.dirty = True
+
+    def records(self):
+        offset = 0
+        while offset + header.size <= self.size:
+            length, crc = header.unpack(self.map[offset:offset + header.size])
+            start = offset + header.size
+            if length == 0 or start + length > self.size:
+                break
+            payload = self.map[start:start + length]
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                # Torn write from a crash, nothing valid follows.
+                log.warning('Journal segment %s is damaged at offset %d, ignoring the rest.', self.path, offset)
+                break
+            yield payload
+            offset = start + length
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class JournaledQueue(Queue):
+    '''
+    A queue that writes everything put on it to memory-mapped segment files
+    in `path` before handing it out. An entry stays in the journal until the
+    consumer that got it calls task_done(), i.e. after it was committed, so
+    whatever was still queued or in flight when the process died is put back
+    on the queue when it starts again. Entries are replayed per segment and
+    in order, so ones that were already done but share a segment with ones
+    that weren't get written again; being upserts, that only costs time.
+
+    Segments are flushed to disk by a background thread every `sync_ms`
+    rather than on every put. A segment whose entries are all done is reset
+    if it is the one being written to and deleted otherwise.
+    '''
+
+    def __init__(self, path, maxsize=0, segment_size=16 * 1024 * 1024, sync_ms=100):
+        Queue.__init__(self, maxsize)
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_interval = sync_ms / 1000.0
+        self.journal_lock = Lock()
+        self.consumers = local()
+        self.segments = []
+        self.number = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.replayed = self._replay()
+        self.active = self._new_segment(self.segment_size)
+
+        t = Thread(target=self._sync_loop, name='db-journal')
+        t.daemon = True
+        t.start()
+
+    def put(self, item, block=True, timeout=None):
+        # Serialize outside of the queue's lock; only the copy into the map happens under it.
+        payload = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        Queue.put(self, (payload, item), block, timeout)
+
+    def _put(self, entry):
+        payload, item = entry
+        with self.journal_lock:
+            if not self.active.fits(payload):
+                self.active.sealed = True
+                self.active = self._new_segment(max(self.segment_size, len(payload) + 2 * header.size))
+            self.active.append(payload)
+            segment = self.active
+        self.queue.append((segment, item))
+
+    def _get(self):
+        segment, item = self.queue.popleft()
+        pending = getattr(self.consumers, 'pending', None)
+        if pending is None:
+            pending = self.consumers.pending = deque()
+        pending.append(segment)
+        return item
+
+    def task_done(self):
+        # Consumers finish their items in the order they got them.
+        pending = getattr(self.consumers, 'pending', None)
+        if pending:
+            segment = pending.popleft()
+            with self.journal_lock:
+                segment.outstanding -= 1
+                if segment.outstanding == 0 and segment is self.active:
+                    segment.rewind()
+        Queue.task_done(self)
+
+    def _new_segment(self, size):
+        self.number += 1
+        segment = Segment(os.path.join(self.path, 'db-{:010d}.journal'.format(self.number)), size)
+        self.segments.append(segment)
+        return segment
+
+    def _replay(self):
+        names = sorted(n for n in os.listdir(self.path) if n.startswith('db-') and n.endswith('.journal'))
+        count = 0
+        for name in names:
+            self.number = max(self.number, int(name[3:-8]))
+            if not os.path.getsize(os.path.join(self.path, name)):
+                # Created but never sized, so never written to either.
+                os.remove(os.path.join(self.path, name))
+                continue
+            segment = Segment(os.path.join(self.path, name), 0)
+            segment.sealed = True
+            self.segments.append(segment)
+            for payload in segment.records():
+                try:
+                    item = pickle.loads(payload)
+                except Exception as e:
+                    log.warning('Skipping unreadable journal entry in %s: %s', name, e)
+                    continue
+                # Bypass maxsize, nobody is consuming yet.
+                segment.outstanding += 1
+                self.queue.append((segment, item))
+                self.unfinished_tasks += 1
+                count += 1
+
+        if count:
+            log.info('Replaying %d queued database updates from the journal.', count)
+        return count
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                with self.journal_lock:
+                    done = [s for s in self.segments if s.sealed and s.outstanding == 0]
+                    for segment in done:
+                        self.segments.remove(segment)
+                    dirty = [s for s in self.segments if s.dirty]
+                    for segment in dirty:
+                        segment.dirty = False
+
+                for segment in dirty:
+                    segment.map.flush()
+                for segment in done:
+                    segment.close()
+                    os.remove(segment.path)
+            except Exception as e:
+                log.exception('Exception in db journal sync: %s', e)
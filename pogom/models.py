@@ -2,47 +2,79 @@
 # -*- coding: utf-8 -*-
 import logging
 import itertools
-import calendar
 import sys
 import gc
 import time
 import geopy
 from peewee import SqliteDatabase, InsertQuery, \
     IntegerField, CharField, DoubleField, BooleanField, \
-    DateTimeField, fn, DeleteQuery, CompositeKey, FloatField, SQL, TextField, JOIN
+    DateTimeField, fn, DeleteQuery, CompositeKey, FloatField, SQL, TextField, JOIN, \
+    OperationalError, InterfaceError
 from playhouse.flask_utils import FlaskDB
 from playhouse.pool import PooledMySQLDatabase
 from playhouse.shortcuts import RetryOperationalError
 from playhouse.migrate import migrate, MySQLMigrator, SqliteMigrator
 from datetime import datetime, timedelta
 from base64 import b64encode
-from cachetools import TTLCache
-from cachetools import cached
+from collections import OrderedDict
+from threading import Lock
+from queue import Empty
 
 from . import config
 from .utils import get_pokemon_name, get_pokemon_rarity, get_pokemon_types, get_args, get_move_name, get_move_damage, get_move_energy, get_move_type
 from .transform import transform_from_wgs_to_gcj, get_new_coords
 from .customLog import printPokemon
+from .spatial import ActivePokemonIndex, query_difference
+from .expiring import ExpiringSet
+from .spawnpoints import SpawnpointTable
+from .changelog import ChangeLog
+from .tiles import TileCache
+from .plans import PlanCache
+from .geoindex import GeoIndex
+from .history import HistoryPartitions
+from .cleanup import BatchCleaner
+from .dbpool import ConnectionManager, WaitingPool
+from .replicas import ReplicaRouter, ReplicaRouting
+from .events import EventBatch, PokemonSeen, PokestopSeen, GymSeen, LocationScanned, GymDetailsSeen, event_bus
+from .deadletter import DeadLetters
 
 log = logging.getLogger(__name__)
 
 args = get_args()
 flaskDb = FlaskDB()
-cache = TTLCache(maxsize=100, ttl=60 * 5)
-
-db_schema_version = 10
-
-
-class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
+active_pokemon = ActivePokemonIndex()
+known_encounters = ExpiringSet()
+# Encounters this process knows are counted in the seen statistics already,
+# so rewrites don't each have to ask the database (CountedEncounter).
+seen_encounters = ExpiringSet()
+spawnpoints = SpawnpointTable()
+change_log = ChangeLog()
+# Coordinates are shifted after querying in China, which tiles can't follow.
+tile_cache = TileCache(0 if args.china else args.tile_cache_ttl)
+plans = PlanCache()
+geo_index = GeoIndex()
+dead_letters = DeadLetters(args.dead_letter_file)
+db_connections = ConnectionManager()
+db_replicas = ReplicaRouter(args.db_replica_max_lag)
+
+db_schema_version = 18
+
+
+class MyRetryDB(ReplicaRouting, RetryOperationalError, WaitingPool, PooledMySQLDatabase):
     pass
 
 
 def init_database(app):
     if args.db_type == 'mysql':
         log.info('Connecting to MySQL database on %s:%i', args.db_host, args.db_port)
-        connections = args.db_max_connections
-        if hasattr(args, 'accounts'):
-            connections *= len(args.accounts)
+        # One each for the db updaters, the shared readers of the search
+        # workers, and a few for the web server and the cleaner, however
+        # many accounts there are.
+        connections = args.db_max_connections or args.db_threads + args.db_read_connections + 10
+        if connections < args.db_threads + args.db_read_connections + 1:
+            log.warning('--db-max_connections is the total for all threads now, not per account. %d leaves no '
+                        'connection for the web server next to %d db threads and %d read connections, '
+                        'expect it to wait for them.', connections, args.db_threads, args.db_read_connections)
         db = MyRetryDB(
             args.db_name,
             user=args.db_user,
@@ -50,13 +82,30 @@ def init_database(app):
             host=args.db_host,
             port=args.db_port,
             max_connections=connections,
-            stale_timeout=300)
+            stale_timeout=300,
+            manager=db_connections,
+            router=db_replicas)
+        replicas = []
+        for replica in args.db_replica:
+            host, _, port = replica.partition(':')
+            log.info('Reading from the MySQL replica on %s:%i for the web server', host, int(port or args.db_port))
+            replicas.append(MyRetryDB(
+                args.db_name,
+                user=args.db_user,
+                password=args.db_pass,
+                host=host,
+                port=int(port or args.db_port),
+                max_connections=connections,
+                stale_timeout=300))
+        db_replicas.init(replicas)
     else:
         log.info('Connecting to local SQLite database')
-        db = SqliteDatabase(args.db)
+        # The spatial index triggers also have to see the rows a REPLACE deletes.
+        db = SqliteDatabase(args.db, pragmas=[('recursive_triggers', 'on')])
 
     app.config['DATABASE'] = db
     flaskDb.init_app(app)
+    db_connections.init(db, args.db_read_connections)
     if args.clean_timers_data:
         log.info('Cleaning Spawns timer data...')
         Pokemon.clean_timers_data()
@@ -98,64 +147,46 @@ class Pokemon(BaseModel):
 
     @staticmethod
     def get_active(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
-        query = Pokemon.select()
+        if active_pokemon.ready:
+            return Pokemon._decorate(Pokemon._get_active_from_index(
+                swLat, swLng, neLat, neLng, timestamp, oSwLat, oSwLng, oNeLat, oNeLng))
+
+        now = datetime.utcnow()
         if not (swLat and swLng and neLat and neLng):
-            query = (query
-                     .where(Pokemon.disappear_time > datetime.utcnow())
-                     .dicts())
-        elif timestamp > 0:
+            plan = plans.get(('pokemon', 'all'), lambda p: (
+                Pokemon.select()
+                       .where(Pokemon.disappear_time > p.datetime('now'))))
+            return Pokemon._decorate(plan.execute(now=now))
+
+        bounds = dict(swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng)
+        in_view = plans.get(('pokemon', 'bbox'), lambda p: (
+            Pokemon.select()
+                   .where((Pokemon.disappear_time > p.datetime('now')) &
+                          in_bbox(Pokemon, p))))
+        if timestamp > 0:
             # If timestamp is known only load modified pokemon.
-            query = (query
-                     .where(((Pokemon.last_modified > datetime.utcfromtimestamp(timestamp / 1000)) &
-                             (Pokemon.disappear_time > datetime.utcnow())) &
-                            ((Pokemon.latitude >= swLat) &
-                             (Pokemon.longitude >= swLng) &
-                             (Pokemon.latitude <= neLat) &
-                             (Pokemon.longitude <= neLng)))
-                     .dicts())
+            plan = plans.get(('pokemon', 'since'), lambda p: (
+                Pokemon.select()
+                       .where(((Pokemon.last_modified > p.datetime('since')) &
+                               (Pokemon.disappear_time > p.datetime('now'))) &
+                              in_bbox(Pokemon, p))))
+            rows = plan.execute(now=now, since=datetime.utcfromtimestamp(timestamp / 1000), **bounds)
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send Pokemon in view but exclude those within old boundaries. Only send newly uncovered Pokemon.
-            query = (query
-                     .where(((Pokemon.disappear_time > datetime.utcnow()) &
-                            (((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))) &
-                            ~((Pokemon.disappear_time > datetime.utcnow()) &
-                              (Pokemon.latitude >= oSwLat) &
-                              (Pokemon.longitude >= oSwLng) &
-                              (Pokemon.latitude <= oNeLat) &
-                              (Pokemon.longitude <= oNeLng))))
-                     .dicts())
+            rows = in_uncovered(in_view, (swLat, swLng, neLat, neLng), (oSwLat, oSwLng, oNeLat, oNeLng), now=now)
         else:
-            query = (query
-                     .where((Pokemon.disappear_time > datetime.utcnow()) &
-                            (((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))))
-                     .dicts())
-
-        # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append().
-        gc.disable()
-
-        pokemons = []
-        for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokemons.append(p)
-
-        # Re-enable the GC.
-        gc.enable()
+            rows = in_view.execute(now=now, **bounds)
 
-        return pokemons
+        return Pokemon._decorate(rows)
 
     @staticmethod
     def get_active_by_id(ids, swLat, swLng, neLat, neLng):
+        if active_pokemon.ready:
+            bounds = None
+            if swLat and swLng and neLat and neLng:
+                bounds = (float(swLat), float(swLng), float(neLat), float(neLng))
+            return Pokemon._decorate(active_pokemon.query(bounds, ids=set(ids)))
+
         if not (swLat and swLng and neLat and neLng):
             query = (Pokemon
                      .select()
@@ -167,69 +198,78 @@ class Pokemon(BaseModel):
                      .select()
                      .where((Pokemon.pokemon_id << ids) &
                             (Pokemon.disappear_time > datetime.utcnow()) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.latitude <= neLat) &
-                            (Pokemon.longitude <= neLng))
+                            geo_index.within(Pokemon, swLat, swLng, neLat, neLng))
                      .dicts())
 
-        # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append().
-        gc.disable()
+        return Pokemon._decorate(query)
 
-        pokemons = []
-        for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokemons.append(p)
+    @staticmethod
+    def _get_active_from_index(swLat, swLng, neLat, neLng, timestamp, oSwLat, oSwLng, oNeLat, oNeLng):
+        # Same cases as the database query in get_active, answered from memory.
+        if not (swLat and swLng and neLat and neLng):
+            return active_pokemon.query()
 
-        # Re-enable the GC.
-        gc.enable()
+        bounds = (float(swLat), float(swLng), float(neLat), float(neLng))
+        if timestamp > 0:
+            return active_pokemon.query(bounds, since=datetime.utcfromtimestamp(timestamp / 1000))
+        elif oSwLat and oSwLng and oNeLat and oNeLng:
+            exclude = (float(oSwLat), float(oSwLng), float(oNeLat), float(oNeLng))
+            return active_pokemon.query(bounds, exclude=exclude)
+        return active_pokemon.query(bounds)
+
+    @staticmethod
+    def get_changed(rows):
+        now = datetime.utcnow()
+        return Pokemon._decorate([dict(p) for p in rows if p['disappear_time'] > now])
+
+    @staticmethod
+    def iter_active():
+        # Every active Pokemon, read and decorated one at a time as they're consumed.
+        if active_pokemon.ready:
+            rows = active_pokemon.iter_all()
+        else:
+            rows = (Pokemon
+                    .select()
+                    .where(Pokemon.disappear_time > datetime.utcnow())
+                    .dicts()
+                    .iterator())
+        return itertools.imap(Pokemon._decorate_row, rows)
 
-        return pokemons
+    @staticmethod
+    def _decorate(rows):
+        return [Pokemon._decorate_row(p) for p in rows]
+
+    @staticmethod
+    def _decorate_row(p):
+        p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+        p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
+        p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
+        if args.china:
+            p['latitude'], p['longitude'] = \
+                transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
+        return p
+
+    @staticmethod
+    def load_active():
+        # Seed the memory index with what's still alive in the database.
+        query = list(Pokemon
+                     .select()
+                     .where(Pokemon.disappear_time > datetime.utcnow())
+                     .dicts())
+        active_pokemon.load(query)
+        known_encounters.load(((p['encounter_id'], p['spawnpoint_id']), p['disappear_time']) for p in query)
 
     @classmethod
-    @cached(cache)
     def get_seen(cls, timediff):
-        if timediff:
-            timediff = datetime.utcnow() - timediff
-        pokemon_count_query = (Pokemon
-                               .select(Pokemon.pokemon_id,
-                                       fn.COUNT(Pokemon.pokemon_id).alias('count'),
-                                       fn.MAX(Pokemon.disappear_time).alias('lastappeared')
-                                       )
-                               .where(Pokemon.disappear_time > timediff)
-                               .group_by(Pokemon.pokemon_id)
-                               .alias('counttable')
-                               )
-        query = (Pokemon
-                 .select(Pokemon.pokemon_id,
-                         Pokemon.disappear_time,
-                         Pokemon.latitude,
-                         Pokemon.longitude,
-                         pokemon_count_query.c.count)
-                 .join(pokemon_count_query, on=(Pokemon.pokemon_id == pokemon_count_query.c.pokemon_id))
-                 .distinct()
-                 .where(Pokemon.disappear_time == pokemon_count_query.c.lastappeared)
-                 .dicts()
-                 )
-
-        # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append().
-        gc.disable()
+        seen = SeenBucket.get_seen(timediff)
 
         pokemons = []
         total = 0
-        for p in query:
+        for p in seen:
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
             pokemons.append(p)
             total += p['count']
 
-        # Re-enable the GC.
-        gc.enable()
-
         return {'pokemon': pokemons, 'total': total}
 
     @classmethod
@@ -237,20 +277,14 @@ class Pokemon(BaseModel):
         '''
         :param pokemon_id: id of pokemon that we need appearances for
         :param timediff: limiting period of the selection
-        :return: list of  pokemon  appearances over a selected period
+        :return: appearances per spawnpoint over a selected period, as parallel lists
         '''
-        if timediff:
-            timediff = datetime.utcnow() - timediff
-        query = (Pokemon
-                 .select(Pokemon.latitude, Pokemon.longitude, Pokemon.pokemon_id, fn.Count(Pokemon.spawnpoint_id).alias('count'), Pokemon.spawnpoint_id)
-                 .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
-                 .group_by(Pokemon.latitude, Pokemon.longitude, Pokemon.pokemon_id, Pokemon.spawnpoint_id)
-                 .dicts()
-                 )
-
-        return list(query)
+        try:
+            pokemon_id = int(pokemon_id)
+        except (TypeError, ValueError):
+            # No (valid) Pokemon asked for, nothing appeared.
+            return {'pokemon_id': None, 'spawnpoint_id': [], 'latitude': [], 'longitude': [], 'count': []}
+        return AppearanceBucket.get_appearances(pokemon_id, timediff)
 
     @classmethod
     def get_appearances_times_by_spawnpoint(cls, pokemon_id, spawnpoint_id, timediff):
@@ -262,17 +296,19 @@ class Pokemon(BaseModel):
         '''
         if timediff:
             timediff = datetime.utcnow() - timediff
-        query = (Pokemon
-                 .select(Pokemon.disappear_time)
-                 .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.spawnpoint_id == spawnpoint_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
-                 .order_by(Pokemon.disappear_time.asc())
-                 .tuples()
-                 )
-
-        return list(itertools.chain(*query))
+        times = []
+        for model in history.models_since(flaskDb.database, timediff or None):
+            query = (model
+                     .select(model.disappear_time)
+                     .where((model.pokemon_id == pokemon_id) &
+                            (model.spawnpoint_id == spawnpoint_id) &
+                            (model.disappear_time > timediff)
+                            )
+                     .tuples()
+                     )
+            times.extend(itertools.chain(*query))
+
+        return sorted(times)
 
     @classmethod
     def get_spawn_time(cls, disappear_time):
@@ -280,29 +316,27 @@ class Pokemon(BaseModel):
 
     @classmethod
     def clean_timers_data(cls):
-        query = Pokemon.update(time_detail=-1).where(Pokemon.time_detail == 1)
-        query.execute()
+        for model in history.models_since(flaskDb.database):
+            if model.table_exists():
+                model.update(time_detail=-1).where(model.time_detail == 1).execute()
+        # The spawnpoint timings were learned from those; the next sighting starts a new vote.
+        if Spawnpoint.table_exists():
+            Spawnpoint.update(time_detail=-1, samples=0, confidence=0).execute()
 
     @classmethod
     def predict_disappear_time(cls, spawnpoint_id):
         now = datetime.utcnow()
         predicted = -1
 
-        query = (Pokemon
-                 .select(Pokemon.disappear_time)
-                 .where((Pokemon.spawnpoint_id == spawnpoint_id) &
-                        (Pokemon.time_detail == 1))
-                 .order_by(Pokemon.last_modified.desc())
-                 .limit(1)).dicts()
-
-        temp = list(query)
-
-        log.debug("Found %d entrie(s) in db as to predict disappear_time" % (len(temp)))
-
-        if len(temp) > 0:
-            disappear_time = temp[0]['disappear_time']
+        if spawnpoints.ready:
+            despawn_sec = spawnpoints.despawn_sec(spawnpoint_id)
+        else:
+            with db_connections.reading():
+                despawn_sec = Spawnpoint.get_despawn_sec(spawnpoint_id)
 
-            predicted = now.replace(minute=disappear_time.minute, second=disappear_time.second)
+        if despawn_sec is not None:
+            minute, second = divmod(despawn_sec, 60)
+            predicted = now.replace(minute=minute, second=second)
 
             if now > predicted:
                 predicted = predicted + timedelta(hours=1)
@@ -312,62 +346,23 @@ class Pokemon(BaseModel):
 
     @classmethod
     def get_spawnpoints(cls, swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
-        subquery = Pokemon.select(Pokemon.spawnpoint_id.alias('spawn_id'), fn.Max(Pokemon.time_detail).alias('td')).group_by(Pokemon.spawnpoint_id).alias("derived")
-        query = Pokemon.select(Pokemon.latitude, Pokemon.longitude, Pokemon.spawnpoint_id, Pokemon.disappear_time, Pokemon.last_modified, subquery.c.td.alias('time_detail'), ((Pokemon.disappear_time.minute * 60) + Pokemon.disappear_time.second).alias('time'), fn.Count(Pokemon.spawnpoint_id).alias('count'))
-
-        query = query.join(subquery, on=(subquery.c.spawn_id == Pokemon.spawnpoint_id))
-        if timestamp > 0:
-            query = (query
-                     .where(((Pokemon.last_modified > datetime.utcfromtimestamp(timestamp / 1000))) &
-                            ((Pokemon.latitude >= swLat) &
-                             (Pokemon.longitude >= swLng) &
-                             (Pokemon.latitude <= neLat) &
-                             (Pokemon.longitude <= neLng)))
-                     .dicts())
-        elif oSwLat and oSwLng and oNeLat and oNeLng:
-            # Send spawnpoints in view but exclude those within old boundaries. Only send newly uncovered spawnpoints.
-            query = (query
-                     .where((((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))) &
-                            ~((Pokemon.latitude >= oSwLat) &
-                              (Pokemon.longitude >= oSwLng) &
-                              (Pokemon.latitude <= oNeLat) &
-                              (Pokemon.longitude <= oNeLng)
-                              ))
-                     .dicts())
-        elif swLat and swLng and neLat and neLng:
-            query = (query
-                     .where((Pokemon.latitude <= neLat) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.longitude <= neLng)
-                            ))
-
-        query = query.group_by(Pokemon.latitude, Pokemon.longitude, Pokemon.spawnpoint_id)
-        queryDict = query.dicts()
-        spawnpoints = {}
-
-        for sp in queryDict:
-            key = sp['spawnpoint_id']
-            disappear_time = cls.get_spawn_time(sp.pop('time'))
-            count = int(sp['count'])
-
-            if key not in spawnpoints:
-                spawnpoints[key] = sp
-
-            if (sp['disappear_time'] - sp['last_modified']) > timedelta(minutes=30):
-                spawnpoints[key]['special'] = True
-
-            if 'time' not in spawnpoints[key] or count >= spawnpoints[key]['count']:
-                spawnpoints[key]['time'] = disappear_time
-                spawnpoints[key]['count'] = count
-
-        for sp in spawnpoints.values():
-            del sp['count']
+        results = []
+        for sp in Spawnpoint.get_in_bounds(swLat, swLng, neLat, neLng, timestamp, oSwLat, oSwLng, oNeLat, oNeLng):
+            if sp['despawn_sec'] is None:
+                continue
+            result = {
+                'spawnpoint_id': sp['spawnpoint_id'],
+                'latitude': sp['latitude'],
+                'longitude': sp['longitude'],
+                'time_detail': sp['time_detail'],
+                'last_modified': sp['last_modified'],
+                'time': cls.get_spawn_time(sp['despawn_sec']),
+            }
+            if sp['special']:
+                result['special'] = True
+            results.append(result)
 
-        return list(spawnpoints.values())
+        return results
 
     @classmethod
     def get_spawnpoints_in_hex(cls, center, steps):
@@ -375,24 +370,6 @@ class Pokemon(BaseModel):
 
         n, e, s, w = hex_bounds(center, steps)
 
-        query = (Pokemon
-                 .select(Pokemon.latitude.alias('lat'),
-                         Pokemon.longitude.alias('lng'),
-                         ((Pokemon.disappear_time.minute * 60) + Pokemon.disappear_time.second).alias('time'),
-                         Pokemon.spawnpoint_id
-                         ))
-        subquery = Pokemon.select(Pokemon.spawnpoint_id.alias('spawn_id'), fn.Max(Pokemon.time_detail).alias('td')).group_by(Pokemon.spawnpoint_id).alias("derived")
-        query = query.join(subquery, on=(subquery.c.spawn_id == Pokemon.spawnpoint_id))
-
-        query = (query.where((Pokemon.latitude <= n) &
-                             (Pokemon.latitude >= s) &
-                             (Pokemon.longitude >= w) &
-                             (Pokemon.longitude <= e)
-                             ))
-        query = query.group_by(Pokemon.spawnpoint_id)
-
-        s = list(query.dicts())
-
         # The distance between scan circles of radius 70 in a hex is 121.2436
         # steps - 1 to account for the center circle then add 70 for the edge.
         step_distance = ((steps - 1) * 121.2436) + 70
@@ -400,21 +377,361 @@ class Pokemon(BaseModel):
         # Uses the direct geopy distance between the center and the spawnpoint.
         filtered = []
 
-        for idx, sp in enumerate(s):
-            if geopy.distance.distance(center, (sp['lat'], sp['lng'])).meters <= step_distance:
-                filtered.append(s[idx])
-
-        # At this point, 'time' is DISAPPEARANCE time, we're going to morph it to APPEARANCE time.
-        for location in filtered:
-            # examples: time    shifted
-            #           0       (   0 + 2700) = 2700 % 3600 = 2700 (0th minute to 45th minute, 15 minutes prior to appearance as time wraps around the hour.)
-            #           1800    (1800 + 2700) = 4500 % 3600 =  900 (30th minute, moved to arrive at 15th minute.)
-            # todo: this DOES NOT ACCOUNT for pokemons that appear sooner and live longer, but you'll _always_ have at least 15 minutes, so it works well enough.
-            location['time'] = cls.get_spawn_time(location['time'])
+        for sp in Spawnpoint.get_in_bounds(s, w, n, e):
+            if sp['despawn_sec'] is None:
+                continue
+            if geopy.distance.distance(center, (sp['latitude'], sp['longitude'])).meters <= step_distance:
+                # The spawnpoint's despawn second is DISAPPEARANCE time, we're going to morph it to APPEARANCE time.
+                # examples: time    shifted
+                #           0       (   0 + 2700) = 2700 % 3600 = 2700 (0th minute to 45th minute, 15 minutes prior to appearance as time wraps around the hour.)
+                #           1800    (1800 + 2700) = 4500 % 3600 =  900 (30th minute, moved to arrive at 15th minute.)
+                # todo: this DOES NOT ACCOUNT for pokemons that appear sooner and live longer, but you'll _always_ have at least 15 minutes, so it works well enough.
+                filtered.append({
+                    'lat': sp['latitude'],
+                    'lng': sp['longitude'],
+                    'time': cls.get_spawn_time(sp['despawn_sec']),
+                    'spawnpoint_id': sp['spawnpoint_id'],
+                })
 
         return filtered
 
 
+class Spawnpoint(BaseModel):
+    spawnpoint_id = CharField(primary_key=True, max_length=50)
+    latitude = DoubleField(null=True)
+    longitude = DoubleField(null=True)
+    despawn_sec = IntegerField(null=True)  # Second of the hour the spawnpoint's Pokemon disappear at.
+    confidence = FloatField(default=0)  # Lead of despawn_sec in the vote over all samples, 1.0 if they all agree.
+    samples = IntegerField(default=0)  # Sightings despawn_sec was voted from.
+    count = IntegerField(default=0)  # Encounters seen here.
+    special = BooleanField(default=False)  # Pokemon here may appear up to an hour before they disappear.
+    time_detail = IntegerField(default=-1)  # Best time_detail of the Pokemon seen here.
+    last_modified = DateTimeField(index=True, default=datetime.utcnow)
+
+    class Meta:
+        indexes = ((('latitude', 'longitude'), False),)
+
+    @staticmethod
+    def load():
+        spawnpoints.load(Spawnpoint.select().dicts())
+
+    @staticmethod
+    def get_in_bounds(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
+        if not (swLat and swLng and neLat and neLng):
+            # Everywhere.
+            if spawnpoints.ready:
+                return spawnpoints.query(None)
+            return list(plans.get(('spawnpoint', 'all'), lambda p: Spawnpoint.select()).execute())
+
+        bounds = (float(swLat), float(swLng), float(neLat), float(neLng))
+        since = datetime.utcfromtimestamp(timestamp / 1000) if timestamp > 0 else None
+        exclude = None
+        if not since and oSwLat and oSwLng and oNeLat and oNeLng:
+            exclude = (float(oSwLat), float(oSwLng), float(oNeLat), float(oNeLng))
+
+        if spawnpoints.ready:
+            return spawnpoints.query(bounds, since=since, exclude=exclude)
+
+        def in_view(p):
+            return (Spawnpoint.select()
+                              .where((Spawnpoint.latitude >= p.float('swLat')) &
+                                     (Spawnpoint.longitude >= p.float('swLng')) &
+                                     (Spawnpoint.latitude <= p.float('neLat')) &
+                                     (Spawnpoint.longitude <= p.float('neLng'))))
+
+        values = dict(zip(('swLat', 'swLng', 'neLat', 'neLng'), bounds))
+        if since:
+            plan = plans.get(('spawnpoint', 'since'), lambda p: (
+                in_view(p).where(Spawnpoint.last_modified > p.datetime('since'))))
+            rows = plan.execute(since=since, **values)
+        elif exclude:
+            rows = in_uncovered(plans.get(('spawnpoint', 'bbox'), in_view), bounds, exclude)
+        else:
+            rows = plans.get(('spawnpoint', 'bbox'), in_view).execute(**values)
+        return list(rows)
+
+    @staticmethod
+    def observe(pokemon):
+        # SpawnpointTable.observe on the rows in the database, locked until written back.
+        ids = list(set(p['spawnpoint_id'] for p in pokemon))
+        rows = {}
+        with flaskDb.database.atomic():
+            # Within SQLite's limit of parameters.
+            for i in range(0, len(ids), 500):
+                query = Spawnpoint.select().where(Spawnpoint.spawnpoint_id << ids[i:i + 500])
+                if args.db_type == 'mysql':
+                    query = query.for_update()
+                rows.update((sp['spawnpoint_id'], sp) for sp in query.dicts())
+            changed = spawnpoints.observe(pokemon, rows)
+            if changed:
+                bulk_upsert(Spawnpoint, dict(enumerate(changed)))
+
+    @staticmethod
+    def get_despawn_sec(spawnpoint_id):
+        # Only trusted once the server told us, see SpawnpointTable.despawn_sec.
+        query = (Spawnpoint
+                 .select(Spawnpoint.despawn_sec)
+                 .where((Spawnpoint.spawnpoint_id == spawnpoint_id) & (Spawnpoint.time_detail == 1))
+                 .dicts())
+        for sp in query:
+            return sp['despawn_sec']
+        return None
+
+
+class SeenBucket(BaseModel):
+    # Pokemon seen per species and hour ('h') or day ('d') they disappeared in,
+    # along with where the last one of them was.
+    pokemon_id = IntegerField()
+    span = CharField(max_length=1)
+    bucket = DateTimeField()
+    count = IntegerField(default=0)
+    last_seen = DateTimeField()
+    latitude = DoubleField()
+    longitude = DoubleField()
+
+    class Meta:
+        primary_key = CompositeKey('pokemon_id', 'span', 'bucket')
+        # For the cleaner.
+        indexes = ((('span', 'bucket'), False),)
+
+    @staticmethod
+    def buckets(disappear_time):
+        hour = disappear_time.replace(minute=0, second=0, microsecond=0)
+        return (('h', hour), ('d', hour.replace(hour=0)))
+
+    @staticmethod
+    def aggregate(pokemon, totals=None):
+        # Folds Pokemon rows into {(pokemon_id, span, bucket): [count, last_seen, latitude, longitude]}.
+        if totals is None:
+            totals = {}
+        for p in pokemon:
+            for span, bucket in SeenBucket.buckets(p['disappear_time']):
+                key = (p['pokemon_id'], span, bucket)
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = [1, p['disappear_time'], p['latitude'], p['longitude']]
+                else:
+                    total[0] += 1
+                    if p['disappear_time'] > total[1]:
+                        total[1:] = [p['disappear_time'], p['latitude'], p['longitude']]
+        return totals
+
+    @staticmethod
+    def add(totals):
+        # Adds to the counters in the database rather than replacing them, so
+        # several writers (and several db threads) can't lose each other's counts.
+        db = flaskDb.database
+        param = db.interpolation
+        rows = [(pokemon_id, span, bucket, t[0], t[1], t[2], t[3])
+                for (pokemon_id, span, bucket), t in totals.items()]
+
+        with db.atomic():
+            if args.db_type == 'mysql':
+                # Position first, MySQL evaluates these left to right.
+                sql = ('INSERT INTO seenbucket (pokemon_id, span, bucket, count, last_seen, latitude, longitude) '
+                       'VALUES ({0}, {0}, {0}, {0}, {0}, {0}, {0}) ON DUPLICATE KEY UPDATE '
+                       'latitude = IF(VALUES(last_seen) > last_seen, VALUES(latitude), latitude), '
+                       'longitude = IF(VALUES(last_seen) > last_seen, VALUES(longitude), longitude), '
+                       'last_seen = GREATEST(last_seen, VALUES(last_seen)), '
+                       'count = count + VALUES(count)').format(param)
+                for row in rows:
+                    db.execute_sql(sql, row)
+            else:
+                insert = ('INSERT OR IGNORE INTO seenbucket (pokemon_id, span, bucket, count, last_seen, latitude, longitude) '
+                          'VALUES ({0}, {0}, {0}, 0, {0}, {0}, {0})').format(param)
+                update = ('UPDATE seenbucket SET count = count + {0}, '
+                          'latitude = CASE WHEN {0} > last_seen THEN {0} ELSE latitude END, '
+                          'longitude = CASE WHEN {0} > last_seen THEN {0} ELSE longitude END, '
+                          'last_seen = MAX(last_seen, {0}) '
+                          'WHERE pokemon_id = {0} AND span = {0} AND bucket = {0}').format(param)
+                for pokemon_id, span, bucket, count, last_seen, lat, lng in rows:
+                    db.execute_sql(insert, (pokemon_id, span, bucket, last_seen, lat, lng))
+                    db.execute_sql(update, (count, last_seen, lat, last_seen, lng, last_seen,
+                                            pokemon_id, span, bucket))
+
+    @staticmethod
+    def get_seen(timediff):
+        # Whole days, then whole hours, then the Pokemon themselves for the
+        # partial hour at the start of the window.
+        if not timediff:
+            query = SeenBucket.select().where(SeenBucket.span == 'd').dicts()
+            return SeenBucket._combine(query)
+
+        cutoff = datetime.utcnow() - timediff
+        first_hour = cutoff.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        first_day = cutoff.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        if cutoff < datetime.utcnow() - seen_hours_kept:
+            # The hours of that day are cleaned up already, count its Pokemon instead.
+            first_hour = first_day
+
+        buckets = (SeenBucket
+                   .select()
+                   .where(((SeenBucket.span == 'd') & (SeenBucket.bucket >= first_day)) |
+                          ((SeenBucket.span == 'h') & (SeenBucket.bucket >= first_hour) &
+                           (SeenBucket.bucket < first_day)))
+                   .dicts())
+        partial = []
+        for model in history.models_since(flaskDb.database, cutoff):
+            pokemon = (model
+                       .select(model.pokemon_id, model.disappear_time, model.latitude, model.longitude)
+                       .where((model.disappear_time > cutoff) & (model.disappear_time < first_hour))
+                       .dicts())
+            partial.extend({'pokemon_id': p['pokemon_id'], 'count': 1, 'last_seen': p['disappear_time'],
+                            'latitude': p['latitude'], 'longitude': p['longitude']} for p in pokemon)
+
+        return SeenBucket._combine(itertools.chain(buckets, partial))
+
+    @staticmethod
+    def _combine(buckets):
+        seen = {}
+        for b in buckets:
+            s = seen.get(b['pokemon_id'])
+            if s is None:
+                seen[b['pokemon_id']] = {
+                    'pokemon_id': b['pokemon_id'],
+                    'count': b['count'],
+                    'disappear_time': b['last_seen'],
+                    'latitude': b['latitude'],
+                    'longitude': b['longitude'],
+                }
+                continue
+            s['count'] += b['count']
+            if b['last_seen'] > s['disappear_time']:
+                s['disappear_time'] = b['last_seen']
+                s['latitude'] = b['latitude']
+                s['longitude'] = b['longitude']
+        return seen.values()
+
+
+# How long the hourly seen buckets are kept; only the first day of a window needs them.
+seen_hours_kept = timedelta(days=2)
+
+
+class CountedEncounter(BaseModel):
+    # Encounters the seen and appearance counts include, by whoever wrote
+    # them, so rewriting a Pokemon (rescans, the journal after a restart,
+    # dead letters, a second instance) doesn't count it again.
+    encounter_id = CharField(primary_key=True, max_length=50)
+    disappear_time = DateTimeField(index=True)
+
+    @staticmethod
+    def claim(pokemon):
+        '''
+        Records the encounters of `pokemon` as counted and returns the
+        Pokemon that weren't yet. Run it in the transaction counting them.
+        '''
+        db = flaskDb.database
+        sql = '{1} INTO countedencounter (encounter_id, disappear_time) VALUES ({0}, {0})'.format(
+            db.interpolation, CountedEncounter.insert_ignore())
+        new = []
+        for p in pokemon:
+            # Nothing inserted for a duplicate.
+            if db.execute_sql(sql, (p['encounter_id'], p['disappear_time'])).rowcount:
+                new.append(p)
+        return new
+
+    @staticmethod
+    def insert_ignore():
+        return 'INSERT IGNORE' if args.db_type == 'mysql' else 'INSERT OR IGNORE'
+
+
+# How long counted encounters are remembered; rewrites come well within that.
+counted_kept = timedelta(days=2)
+
+
+class AppearanceBucket(BaseModel):
+    # Pokemon seen per species, spawnpoint and day they disappeared on.
+    pokemon_id = IntegerField()
+    spawnpoint_id = CharField()
+    day = DateTimeField()
+    count = IntegerField(default=0)
+    latitude = DoubleField()
+    longitude = DoubleField()
+
+    class Meta:
+        primary_key = CompositeKey('pokemon_id', 'spawnpoint_id', 'day')
+        # For the cleaner.
+        indexes = ((('day',), False),)
+
+    @staticmethod
+    def aggregate(pokemon, totals=None):
+        # Folds Pokemon rows into {(pokemon_id, spawnpoint_id, day): [count, latitude, longitude]}.
+        if totals is None:
+            totals = {}
+        for p in pokemon:
+            day = p['disappear_time'].replace(hour=0, minute=0, second=0, microsecond=0)
+            key = (p['pokemon_id'], p['spawnpoint_id'], day)
+            total = totals.get(key)
+            if total is None:
+                totals[key] = [1, p['latitude'], p['longitude']]
+            else:
+                total[0] += 1
+        return totals
+
+    @staticmethod
+    def add(totals):
+        # Adds to the counters, see SeenBucket.add.
+        db = flaskDb.database
+        param = db.interpolation
+        rows = [(pokemon_id, spawnpoint_id, day, t[0], t[1], t[2])
+                for (pokemon_id, spawnpoint_id, day), t in totals.items()]
+
+        with db.atomic():
+            if args.db_type == 'mysql':
+                sql = ('INSERT INTO appearancebucket (pokemon_id, spawnpoint_id, day, count, latitude, longitude) '
+                       'VALUES ({0}, {0}, {0}, {0}, {0}, {0}) ON DUPLICATE KEY UPDATE '
+                       'count = count + VALUES(count)').format(param)
+                for row in rows:
+                    db.execute_sql(sql, row)
+            else:
+                insert = ('INSERT OR IGNORE INTO appearancebucket (pokemon_id, spawnpoint_id, day, count, latitude, longitude) '
+                          'VALUES ({0}, {0}, {0}, 0, {0}, {0})').format(param)
+                update = ('UPDATE appearancebucket SET count = count + {0} '
+                          'WHERE pokemon_id = {0} AND spawnpoint_id = {0} AND day = {0}').format(param)
+                for pokemon_id, spawnpoint_id, day, count, lat, lng in rows:
+                    db.execute_sql(insert, (pokemon_id, spawnpoint_id, day, lat, lng))
+                    db.execute_sql(update, (count, pokemon_id, spawnpoint_id, day))
+
+    @staticmethod
+    def get_appearances(pokemon_id, timediff):
+        # Whole days from the buckets, the Pokemon themselves for the partial day at the start.
+        buckets = (AppearanceBucket
+                   .select(AppearanceBucket.spawnpoint_id, AppearanceBucket.latitude,
+                           AppearanceBucket.longitude, AppearanceBucket.count)
+                   .where(AppearanceBucket.pokemon_id == pokemon_id))
+        partial = []
+        if timediff:
+            cutoff = datetime.utcnow() - timediff
+            first_day = cutoff.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+            buckets = buckets.where(AppearanceBucket.day >= first_day)
+            # Counted per table, the loop below adds them up.
+            partial = itertools.chain.from_iterable(
+                model.select(model.spawnpoint_id, model.latitude, model.longitude,
+                             fn.Count(model.spawnpoint_id).coerce(False).alias('count'))
+                     .where((model.pokemon_id == pokemon_id) &
+                            (model.disappear_time > cutoff) &
+                            (model.disappear_time < first_day))
+                     .group_by(model.spawnpoint_id, model.latitude, model.longitude)
+                     .tuples()
+                for model in history.models_since(flaskDb.database, cutoff))
+
+        # Columnar: one list per field, the same index across them is one spawnpoint.
+        index = {}
+        result = {'pokemon_id': pokemon_id, 'spawnpoint_id': [], 'latitude': [], 'longitude': [], 'count': []}
+        for spawnpoint_id, lat, lng, count in itertools.chain(buckets.tuples(), partial):
+            i = index.get(spawnpoint_id)
+            if i is not None:
+                result['count'][i] += count
+                continue
+            index[spawnpoint_id] = len(result['count'])
+            result['spawnpoint_id'].append(spawnpoint_id)
+            result['latitude'].append(lat)
+            result['longitude'].append(lng)
+            result['count'].append(count)
+
+        return result
+
+
 class Pokestop(BaseModel):
     pokestop_id = CharField(primary_key=True, max_length=50)
     enabled = BooleanField()
@@ -431,61 +748,41 @@ class Pokestop(BaseModel):
     @staticmethod
     def get_stops(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None, lured=False):
 
-        query = Pokestop.select(Pokestop.active_fort_modifier, Pokestop.enabled, Pokestop.latitude, Pokestop.longitude, Pokestop.last_modified, Pokestop.lure_expiration, Pokestop.pokestop_id)
+        def select(p):
+            return Pokestop.select(Pokestop.active_fort_modifier, Pokestop.enabled, Pokestop.latitude, Pokestop.longitude, Pokestop.last_modified, Pokestop.lure_expiration, Pokestop.pokestop_id)
+
+        values = dict(swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng)
+        in_view = plans.get(('pokestop', 'bbox'), lambda p: (
+            select(p)
+            .where(in_bbox(Pokestop, p))))
 
         if not (swLat and swLng and neLat and neLng):
-            query = (query
-                     .dicts())
+            query = plans.get(('pokestop', 'all'), select).execute()
         elif timestamp > 0:
-            query = (query
-                     .where(((Pokestop.last_updated > datetime.utcfromtimestamp(timestamp / 1000))) &
-                            (Pokestop.latitude >= swLat) &
-                            (Pokestop.longitude >= swLng) &
-                            (Pokestop.latitude <= neLat) &
-                            (Pokestop.longitude <= neLng))
-                     .dicts())
+            plan = plans.get(('pokestop', 'since'), lambda p: (
+                select(p)
+                .where(((Pokestop.last_updated > p.datetime('since'))) &
+                       in_bbox(Pokestop, p))))
+            query = plan.execute(since=datetime.utcfromtimestamp(timestamp / 1000), **values)
         elif oSwLat and oSwLng and oNeLat and oNeLng and lured:
-            query = (query
-                     .where((((Pokestop.latitude >= swLat) &
-                              (Pokestop.longitude >= swLng) &
-                              (Pokestop.latitude <= neLat) &
-                              (Pokestop.longitude <= neLng)) &
-                             (Pokestop.active_fort_modifier.is_null(False))) &
-                            ~((Pokestop.latitude >= oSwLat) &
-                              (Pokestop.longitude >= oSwLng) &
-                              (Pokestop.latitude <= oNeLat) &
-                              (Pokestop.longitude <= oNeLng)) &
-                             (Pokestop.active_fort_modifier.is_null(False)))
-                     .dicts())
+            plan = plans.get(('pokestop', 'bbox', 'lured'), lambda p: (
+                select(p)
+                .where(in_bbox(Pokestop, p) &
+                       (Pokestop.active_fort_modifier.is_null(False)))))
+            query = in_uncovered(plan, (swLat, swLng, neLat, neLng), (oSwLat, oSwLng, oNeLat, oNeLng))
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send stops in view but exclude those within old boundaries. Only send newly uncovered stops.
-            query = (query
-                     .where(((Pokestop.latitude >= swLat) &
-                             (Pokestop.longitude >= swLng) &
-                             (Pokestop.latitude <= neLat) &
-                             (Pokestop.longitude <= neLng)) &
-                            ~((Pokestop.latitude >= oSwLat) &
-                              (Pokestop.longitude >= oSwLng) &
-                              (Pokestop.latitude <= oNeLat) &
-                              (Pokestop.longitude <= oNeLng)))
-                     .dicts())
+            query = in_uncovered(in_view, (swLat, swLng, neLat, neLng), (oSwLat, oSwLng, oNeLat, oNeLng))
         elif lured:
-            query = (query
-                     .where(((Pokestop.last_updated > datetime.utcfromtimestamp(timestamp / 1000))) &
-                            ((Pokestop.latitude >= swLat) &
-                             (Pokestop.longitude >= swLng) &
-                             (Pokestop.latitude <= neLat) &
-                             (Pokestop.longitude <= neLng)) &
-                            (Pokestop.active_fort_modifier.is_null(False)))
-                     .dicts())
+            plan = plans.get(('pokestop', 'lured'), lambda p: (
+                select(p)
+                .where(((Pokestop.last_updated > p.datetime('since'))) &
+                       in_bbox(Pokestop, p) &
+                       (Pokestop.active_fort_modifier.is_null(False)))))
+            query = plan.execute(since=datetime.utcfromtimestamp(timestamp / 1000), **values)
 
         else:
-            query = (query
-                     .where((Pokestop.latitude >= swLat) &
-                            (Pokestop.longitude >= swLng) &
-                            (Pokestop.latitude <= neLat) &
-                            (Pokestop.longitude <= neLng))
-                     .dicts())
+            query = in_view.execute(**values)
 
         # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append().
         gc.disable()
@@ -502,6 +799,20 @@ class Pokestop(BaseModel):
 
         return pokestops
 
+    @staticmethod
+    def get_changed(rows):
+        fields = ('active_fort_modifier', 'enabled', 'latitude', 'longitude',
+                  'last_modified', 'lure_expiration', 'pokestop_id')
+        pokestops = []
+        for row in rows:
+            p = dict((f, row[f]) for f in fields)
+            if args.china:
+                p['latitude'], p['longitude'] = \
+                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
+            pokestops.append(p)
+
+        return pokestops
+
 
 class Gym(BaseModel):
     UNCONTESTED = 0
@@ -524,43 +835,40 @@ class Gym(BaseModel):
 
     @staticmethod
     def get_gyms(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
+        values = dict(swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng)
+
         if not (swLat and swLng and neLat and neLng):
-            results = (Gym
-                       .select()
-                       .dicts())
+            results = plans.get(('gym', 'all'), lambda p: Gym.select()).execute()
         elif timestamp > 0:
             # If timestamp is known only send last scanned Gyms.
-            results = (Gym
-                       .select()
-                       .where(((Gym.last_scanned > datetime.utcfromtimestamp(timestamp / 1000)) &
-                              (Gym.latitude >= swLat) &
-                              (Gym.longitude >= swLng) &
-                              (Gym.latitude <= neLat) &
-                              (Gym.longitude <= neLng)))
-                       .dicts())
+            plan = plans.get(('gym', 'since'), lambda p: (
+                Gym.select()
+                   .where((Gym.last_scanned > p.datetime('since')) & in_bbox(Gym, p))))
+            results = plan.execute(since=datetime.utcfromtimestamp(timestamp / 1000), **values)
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send gyms in view but exclude those within old boundaries. Only send newly uncovered gyms.
-            results = (Gym
-                       .select()
-                       .where(((Gym.latitude >= swLat) &
-                               (Gym.longitude >= swLng) &
-                               (Gym.latitude <= neLat) &
-                               (Gym.longitude <= neLng)) &
-                              ~((Gym.latitude >= oSwLat) &
-                                (Gym.longitude >= oSwLng) &
-                                (Gym.latitude <= oNeLat) &
-                                (Gym.longitude <= oNeLng)))
-                       .dicts())
+            plan = plans.get(('gym', 'bbox'), lambda p: Gym.select().where(in_bbox(Gym, p)))
+            results = in_uncovered(plan, (swLat, swLng, neLat, neLng), (oSwLat, oSwLng, oNeLat, oNeLng))
 
         else:
-            results = (Gym
-                       .select()
-                       .where((Gym.latitude >= swLat) &
-                              (Gym.longitude >= swLng) &
-                              (Gym.latitude <= neLat) &
-                              (Gym.longitude <= neLng))
-                       .dicts())
+            results = plans.get(('gym', 'bbox'), lambda p: Gym.select().where(in_bbox(Gym, p))).execute(**values)
+
+        return Gym._with_members(results)
 
+    @staticmethod
+    def get_gyms_by_id(ids):
+        if not ids:
+            return {}
+
+        results = (Gym
+                   .select()
+                   .where(Gym.gym_id << ids)
+                   .dicts())
+
+        return Gym._with_members(results)
+
+    @staticmethod
+    def _with_members(results):
         # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append().
         gc.disable()
 
@@ -675,44 +983,41 @@ class ScannedLocation(BaseModel):
 
     @staticmethod
     def get_recent(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
-        activeTime = (datetime.utcnow() - timedelta(minutes=15))
-        if timestamp > 0:
-            query = (ScannedLocation
-                     .select()
-                     .where(((ScannedLocation.last_modified >= datetime.utcfromtimestamp(timestamp / 1000))) &
-                            (ScannedLocation.latitude >= swLat) &
-                            (ScannedLocation.longitude >= swLng) &
-                            (ScannedLocation.latitude <= neLat) &
-                            (ScannedLocation.longitude <= neLng))
-                     .dicts())
+        active = datetime.utcnow() - timedelta(minutes=15)
+        values = dict(swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng, active=active)
+
+        if not (swLat and swLng and neLat and neLng):
+            plan = plans.get(('scanned', 'all'), lambda p: (
+                ScannedLocation.select()
+                               .where(ScannedLocation.last_modified >= p.datetime('active'))
+                               .order_by(ScannedLocation.last_modified.asc())))
+            query = plan.execute(active=active)
+        elif timestamp > 0:
+            plan = plans.get(('scanned', 'since'), lambda p: (
+                ScannedLocation.select()
+                               .where((ScannedLocation.last_modified >= p.datetime('since')) & in_bbox(ScannedLocation, p))))
+            query = plan.execute(since=datetime.utcfromtimestamp(timestamp / 1000), **values)
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send scannedlocations in view but exclude those within old boundaries. Only send newly uncovered scannedlocations.
-            query = (ScannedLocation
-                     .select()
-                     .where((((ScannedLocation.last_modified >= activeTime)) &
-                             (ScannedLocation.latitude >= swLat) &
-                             (ScannedLocation.longitude >= swLng) &
-                             (ScannedLocation.latitude <= neLat) &
-                             (ScannedLocation.longitude <= neLng)) &
-                            ~(((ScannedLocation.last_modified >= activeTime)) &
-                              (ScannedLocation.latitude >= oSwLat) &
-                              (ScannedLocation.longitude >= oSwLng) &
-                              (ScannedLocation.latitude <= oNeLat) &
-                              (ScannedLocation.longitude <= oNeLng)))
-                     .dicts())
+            plan = plans.get(('scanned', 'active'), lambda p: (
+                ScannedLocation.select()
+                               .where((ScannedLocation.last_modified >= p.datetime('active')) & in_bbox(ScannedLocation, p))))
+            query = in_uncovered(plan, (swLat, swLng, neLat, neLng), (oSwLat, oSwLng, oNeLat, oNeLng), active=active)
         else:
-            query = (ScannedLocation
-                     .select()
-                     .where((ScannedLocation.last_modified >= activeTime) &
-                            (ScannedLocation.latitude >= swLat) &
-                            (ScannedLocation.longitude >= swLng) &
-                            (ScannedLocation.latitude <= neLat) &
-                            (ScannedLocation.longitude <= neLng))
-                     .order_by(ScannedLocation.last_modified.asc())
-                     .dicts())
+            plan = plans.get(('scanned', 'bbox'), lambda p: (
+                ScannedLocation.select()
+                               .where((ScannedLocation.last_modified >= p.datetime('active')) & in_bbox(ScannedLocation, p))
+                               .order_by(ScannedLocation.last_modified.asc())))
+            query = plan.execute(**values)
 
         return list(query)
 
+    @staticmethod
+    def get_changed(rows):
+        return [{'latitude': row['latitude'],
+                 'longitude': row['longitude'],
+                 'last_modified': row['last_modified']} for row in rows]
+
 
 class MainWorker(BaseModel):
     worker_name = CharField(primary_key=True, max_length=50)
@@ -799,6 +1104,25 @@ class GymDetails(BaseModel):
     last_scanned = DateTimeField(default=datetime.utcnow)
 
 
+def in_bbox(model, p):
+    # Bounding box filter for a plan, through the spatial index where there is one.
+    return geo_index.within(model, p.float('swLat'), p.float('swLng'), p.float('neLat'), p.float('neLng'))
+
+
+def in_uncovered(plan, bounds, old_bounds, **values):
+    # Rows of a bbox plan in bounds but not in old_bounds, read with plain
+    # range queries over the uncovered rectangles, which indexes can serve.
+    corners = ('swLat', 'swLng', 'neLat', 'neLng')
+
+    def query(rect):
+        values.update(zip(corners, rect))
+        return plan.execute(**values)
+
+    bounds = tuple(float(c) for c in bounds)
+    old_bounds = tuple(float(c) for c in old_bounds)
+    return list(query_difference(query, bounds, old_bounds))
+
+
 def hex_bounds(center, steps):
     # Make a box that is (70m * step_limit * 2) + 70m away from the center point.
     # Rationale is that you need to travel.
@@ -846,9 +1170,12 @@ def construct_pokemon_dict(pokemons, p, encounter_result, d_t, time_detail=-1):
 
 # todo: this probably shouldn't _really_ be in "models" anymore, but w/e ¯\_(ツ)_/¯
 def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, api):
+    # Everything found here goes out as one batch of events on the event bus, the
+    # database, webhook and push subscribers pick up what they need from there.
     pokemons = {}
     pokestops = {}
     gyms = {}
+    events = []
     skipped = 0
     stopsskipped = 0
     forts = None
@@ -875,22 +1202,27 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                     forts += cell.get('forts', [])
 
     if pokesfound:
-        encounter_ids = [b64encode(str(p['encounter_id'])) for p in wild_pokemon]
-        # For all the wild Pokemon we found check if an active Pokemon is in the database.
-        query = (Pokemon
-                 .select(Pokemon.encounter_id, Pokemon.spawnpoint_id)
-                 .where((Pokemon.disappear_time > datetime.utcnow()) & (Pokemon.encounter_id << encounter_ids))
-                 .dicts())
+        if known_encounters.warm:
+            # Everything this instance wrote is remembered until it disappears, no need to ask the database.
+            encountered_pokemon = known_encounters.known(
+                (b64encode(str(p['encounter_id'])), p['spawn_point_id']) for p in wild_pokemon)
+        else:
+            encounter_ids = [b64encode(str(p['encounter_id'])) for p in wild_pokemon]
+            # For all the wild Pokemon we found check if an active Pokemon is in the database.
+            query = (Pokemon
+                     .select(Pokemon.encounter_id, Pokemon.spawnpoint_id)
+                     .where((Pokemon.disappear_time > datetime.utcnow()) & (Pokemon.encounter_id << encounter_ids))
+                     .dicts())
 
-        # Store all encounter_ids and spawnpoint_id for the pokemon in query (all thats needed to make sure its unique).
-        encountered_pokemon = [(p['encounter_id'], p['spawnpoint_id']) for p in query]
+            # Store all encounter_ids and spawnpoint_id for the pokemon in query (all thats needed to make sure its unique).
+            with db_connections.reading():
+                encountered_pokemon = set((p['encounter_id'], p['spawnpoint_id']) for p in query)
 
         for p in wild_pokemon:
             if (b64encode(str(p['encounter_id'])), p['spawn_point_id']) in encountered_pokemon:
                 # This pokemon has been encountered before, let's check if the new one has valid time. If not, skip.
-                if 0 < p['time_till_hidden_ms'] < 3600000:
-                    Pokemon.delete().where(Pokemon.encounter_id == b64encode(str(p['encounter_id']))).execute()
-                else:
+                # With a valid time the upsert replaces the old row.
+                if not 0 < p['time_till_hidden_ms'] < 3600000:
                     # No valid time. Skip.
                     skipped += 1
                     continue
@@ -935,23 +1267,8 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                 encounter_result = req.get_buddy_walked()
                 encounter_result = req.call()
             construct_pokemon_dict(pokemons, p, encounter_result, d_t, time_detail)
-            if args.webhooks:
-                wh_update_queue.put(('pokemon', {
-                    'encounter_id': b64encode(str(p['encounter_id'])),
-                    'spawnpoint_id': p['spawn_point_id'],
-                    'pokemon_id': p['pokemon_data']['pokemon_id'],
-                    'latitude': p['latitude'],
-                    'longitude': p['longitude'],
-                    'disappear_time': calendar.timegm(d_t.timetuple()),
-                    'last_modified_time': p['last_modified_timestamp_ms'],
-                    'time_until_hidden_ms': p['time_till_hidden_ms'],
-                    'individual_attack': pokemons[p['encounter_id']]['individual_attack'],
-                    'individual_defense': pokemons[p['encounter_id']]['individual_defense'],
-                    'individual_stamina': pokemons[p['encounter_id']]['individual_stamina'],
-                    'move_1': pokemons[p['encounter_id']]['move_1'],
-                    'move_2': pokemons[p['encounter_id']]['move_2'],
-                    'time_detail': time_detail
-                }))
+            events.append(PokemonSeen(pokemons[p['encounter_id']], p['last_modified_timestamp_ms'],
+                                      p['time_till_hidden_ms']))
 
     if fortsfound:
         if config['parse_pokestops']:
@@ -961,7 +1278,8 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                          .select(Pokestop.pokestop_id, Pokestop.last_modified)
                          .where((Pokestop.pokestop_id << stop_ids))
                          .dicts())
-                encountered_pokestops = [(f['pokestop_id'], int((f['last_modified'] - datetime(1970, 1, 1)).total_seconds())) for f in query]
+                with db_connections.reading():
+                    encountered_pokestops = [(f['pokestop_id'], int((f['last_modified'] - datetime(1970, 1, 1)).total_seconds())) for f in query]
 
         for f in forts:
             if config['parse_pokestops'] and f.get('type') == 1:  # Pokestops.
@@ -969,44 +1287,10 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                     lure_expiration = datetime.utcfromtimestamp(
                         f['last_modified_timestamp_ms'] / 1000.0) + timedelta(minutes=30)
                     active_fort_modifier = f['active_fort_modifier']
-                    if args.webhooks and args.webhook_updates_only:
-                        wh_update_queue.put(('pokestop', {
-                            'pokestop_id': b64encode(str(f['id'])),
-                            'enabled': f['enabled'],
-                            'latitude': f['latitude'],
-                            'longitude': f['longitude'],
-                            'last_modified_time': f['last_modified_timestamp_ms'],
-                            'lure_expiration': calendar.timegm(lure_expiration.timetuple()),
-                            'active_fort_modifier': active_fort_modifier
-                        }))
                 else:
                     lure_expiration, active_fort_modifier = None, None
 
-                # Send all pokéstops to webhooks.
-                if args.webhooks and not args.webhook_updates_only:
-                    # Explicitly set 'webhook_data', in case we want to change the information pushed to webhooks,
-                    # similar to above and previous commits.
-                    l_e = None
-
-                    if lure_expiration is not None:
-                        l_e = calendar.timegm(lure_expiration.timetuple())
-
-                    wh_update_queue.put(('pokestop', {
-                        'pokestop_id': b64encode(str(f['id'])),
-                        'enabled': f['enabled'],
-                        'latitude': f['latitude'],
-                        'longitude': f['longitude'],
-                        'last_modified': f['last_modified_timestamp_ms'],
-                        'lure_expiration': l_e,
-                        'active_fort_modifier': active_fort_modifier
-                    }))
-
-                if (f['id'], int(f['last_modified_timestamp_ms'] / 1000.0)) in encountered_pokestops:
-                    # If pokestop has been encountered before and hasn't changed dont process it.
-                    stopsskipped += 1
-                    continue
-
-                pokestops[f['id']] = {
+                pokestop = {
                     'pokestop_id': f['id'],
                     'enabled': f['enabled'],
                     'latitude': f['latitude'],
@@ -1017,22 +1301,17 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                     'active_fort_modifier': active_fort_modifier
                 }
 
-            elif config['parse_gyms'] and f.get('type') is None:  # Currently, there are only stops and gyms
-                # Send gyms to webhooks.
-                if args.webhooks and not args.webhook_updates_only:
-                    # Explicitly set 'webhook_data', in case we want to change the information pushed to webhooks,
-                    # similar to above and previous commits.
-                    wh_update_queue.put(('gym', {
-                        'gym_id': b64encode(str(f['id'])),
-                        'team_id': f.get('owned_by_team', 0),
-                        'guard_pokemon_id': f.get('guard_pokemon_id', 0),
-                        'gym_points': f.get('gym_points', 0),
-                        'enabled': f['enabled'],
-                        'latitude': f['latitude'],
-                        'longitude': f['longitude'],
-                        'last_modified': f['last_modified_timestamp_ms']
-                    }))
+                if (f['id'], int(f['last_modified_timestamp_ms'] / 1000.0)) in encountered_pokestops:
+                    # If pokestop has been encountered before and hasn't changed dont process it.
+                    # The all-stops webhooks still want to hear about it.
+                    stopsskipped += 1
+                    events.append(PokestopSeen(pokestop, f['last_modified_timestamp_ms'], changed=False))
+                    continue
+
+                pokestops[f['id']] = pokestop
+                events.append(PokestopSeen(pokestop, f['last_modified_timestamp_ms']))
 
+            elif config['parse_gyms'] and f.get('type') is None:  # Currently, there are only stops and gyms
                 gyms[f['id']] = {
                     'gym_id': f['id'],
                     'team_id': f.get('owned_by_team', 0),
@@ -1044,13 +1323,7 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                     'last_modified': datetime.utcfromtimestamp(
                         f['last_modified_timestamp_ms'] / 1000.0),
                 }
-
-    if len(pokemons):
-        db_update_queue.put((Pokemon, pokemons))
-    if len(pokestops):
-        db_update_queue.put((Pokestop, pokestops))
-    if len(gyms):
-        db_update_queue.put((Gym, gyms))
+                events.append(GymSeen(gyms[f['id']], f['last_modified_timestamp_ms']))
 
     log.info('Parsing found %d pokemons, %d pokestops, and %d gyms.',
              len(pokemons) + skipped,
@@ -1061,10 +1334,11 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
               skipped,
               stopsskipped)
 
-    db_update_queue.put((ScannedLocation, {0: {
+    events.append(LocationScanned({
         'latitude': step_location[0],
         'longitude': step_location[1],
-    }}))
+    }))
+    event_bus.publish(events)
 
     return {
         'count': skipped + stopsskipped + len(pokemons) + len(pokestops) + len(gyms),
@@ -1077,6 +1351,7 @@ def parse_gyms(args, gym_responses, wh_update_queue):
     gym_members = {}
     gym_pokemon = {}
     trainers = {}
+    events = []
 
     i = 0
     for g in gym_responses.values():
@@ -1158,7 +1433,7 @@ def parse_gyms(args, gym_responses, wh_update_queue):
 
             i += 1
         if args.webhooks:
-            wh_update_queue.put(('gym_details', webhook_data))
+            events.append(GymDetailsSeen(webhook_data))
 
     # All this database stuff is synchronous (not using the upsert queue) on purpose.
     # Since the search workers load the GymDetails model from the database to determine if a gym
@@ -1190,8 +1465,167 @@ def parse_gyms(args, gym_responses, wh_update_queue):
              len(gym_details),
              len(gym_members))
 
+    # Like parse_map's, so a slow webhook only costs it its oldest updates.
+    event_bus.publish(events)
+
+
+event_models = {
+    'pokemon': (Pokemon, 'encounter_id'),
+    'pokestop': (Pokestop, 'pokestop_id'),
+    'gym': (Gym, 'gym_id'),
+    'scanned': (ScannedLocation, None),
+}
+
+
+def db_updates(item):
+    # The queue carries event batches from parse_map and (model, data) tuples from everything else.
+    if not isinstance(item, EventBatch):
+        return [item]
+
+    updates = {}
+    for event in item:
+        if event.kind == 'pokestop' and not event.changed:
+            continue
+        model, key = event_models[event.kind]
+        data = updates.setdefault(model, {})
+        data[event.row[key] if key else len(data)] = event.row
+    return updates.items()
+
+
+class UpdateBatch(object):
+    '''
+    Collects queued updates per model, keyed by primary key so a row that
+    was queued more than once is only written in its newest version.
+    '''
+
+    def __init__(self):
+        self.models = OrderedDict()
+        self.items = 0
+        self.rows_in = 0
+        self.rows = 0
+
+    def add(self, item):
+        self.items += 1
+        for model, data in db_updates(item):
+            rows = self.models.get(model)
+            if rows is None:
+                rows = self.models[model] = OrderedDict()
+            key = model._meta.primary_key
+            for row in data.values():
+                self.rows_in += 1
+                if isinstance(key, CompositeKey):
+                    pk = tuple(row.get(name) for name in key.field_names)
+                else:
+                    pk = row.get(key.name)
+                if pk not in rows:
+                    self.rows += 1
+                else:
+                    # Later queued means newer; move it to the end as well.
+                    del rows[pk]
+                rows[pk] = row
+
+    def write(self):
+        '''
+        Writes the whole batch in one transaction. When the database is
+        unavailable or the transaction runs into a deadlock or lock wait,
+        it is retried whole after a pause, up to `upsert_retries` times;
+        when rows are refused or the retries run out, the batch is written
+        chunk by chunk, which retries, bisects and sets rows aside on its
+        own. Nothing is waited for with a transaction open, and the
+        in-memory views only hear about rows once they are committed.
+        '''
+        delay = upsert_backoff
+        for attempt in range(1, upsert_retries + 1):
+            try:
+                with flaskDb.database.atomic():
+                    for model, rows in self.models.items():
+                        bulk_upsert(model, rows, notify=False)
+                written = [(model, rows.values()) for model, rows in self.models.items()]
+                break
+            except Exception as e:
+                if not transient(e) or attempt == upsert_retries:
+                    log.warning('Writing a batch failed, writing it chunk by chunk: %s', e)
+                    written = [(model, bulk_upsert(model, rows, notify=False)) for model, rows in self.models.items()]
+                    break
+                error = e
+            # Rolled back by now, so no locks are held meanwhile.
+            db_updater_stats.count('retries')
+            log.warning('%s... Retrying the batch in %.1f seconds', error, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, upsert_max_backoff)
+
+        # The batch is committed; what follows can't make it fail anymore.
+        for model, rows in written:
+            if rows:
+                try:
+                    upserted(model, rows)
+                except Exception as e:
+                    log.exception('Updating the in-memory views after writing %s failed: %s', model.__name__, e)
+
+    def dead_letter(self, error):
+        # For a batch that couldn't be written at all, so its rows aren't lost.
+        for model, rows in self.models.items():
+            if rows:
+                db_updater_stats.count('dead_letters')
+                dead_letters.write(model.__name__, rows.values(), error)
+
+
+class UpdaterStats(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.batches = 0
+        self.items = 0
+        self.rows_in = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.last = {}
+        self.failures = {'retries': 0, 'bisections': 0, 'dead_letters': 0}
+
+    def record(self, batch, seconds, queued):
+        with self.lock:
+            self.batches += 1
+            self.items += batch.items
+            self.rows_in += batch.rows_in
+            self.rows += batch.rows
+            self.seconds += seconds
+            self.last = {
+                'items': batch.items,
+                'rows_in': batch.rows_in,
+                'rows': batch.rows,
+                'ms': int(seconds * 1000),
+                'queued': queued,
+            }
+
+    def count(self, failure):
+        with self.lock:
+            self.failures[failure] += 1
+
+    def latency(self):
+        # Seconds the last batch took to write.
+        with self.lock:
+            return self.last.get('ms', 0) / 1000.0
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'rows_in': self.rows_in,
+                'rows': self.rows,
+                'avg_ms': int(self.seconds * 1000 / self.batches) if self.batches else 0,
+                'last': dict(self.last),
+                'failures': dict(self.failures),
+            }
+
+
+db_updater_stats = UpdaterStats()
+db_cleaner = BatchCleaner(latency=db_updater_stats.latency)
+
 
 def db_updater(args, q):
+    window = args.db_batch_window / 1000.0
+
     # The forever loop.
     while True:
         try:
@@ -1199,18 +1633,45 @@ def db_updater(args, q):
             while True:
                 try:
                     flaskDb.connect_db()
+                    db_connections.dedicated()
                     break
                 except Exception as e:
                     log.warning('%s... Retrying', e)
 
             # Loop the queue.
             while True:
-                model, data = q.get()
-                bulk_upsert(model, data)
-                q.task_done()
-                log.debug('Upserted to %s, %d records (upsert queue remaining: %d)',
-                          model.__name__,
-                          len(data),
+                # Wait for something to do, then keep collecting until the window closes or the batch is full.
+                batch = UpdateBatch()
+                try:
+                    batch.add(q.get())
+                    deadline = time.time() + window
+                    while batch.rows < args.db_batch_size:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            batch.add(q.get(timeout=remaining))
+                        except Empty:
+                            break
+
+                    started = time.time()
+                    try:
+                        batch.write()
+                    except Exception as e:
+                        log.exception('Writing a batch failed, setting it aside in %s: %s', args.dead_letter_file, e)
+                        batch.dead_letter(e)
+                finally:
+                    # Every item taken off the queue is done with, written or not: a journal
+                    # releases them in the order they were handed out.
+                    for i in range(batch.items):
+                        q.task_done()
+
+                db_updater_stats.record(batch, time.time() - started, q.qsize())
+                log.debug('Upserted %d queued updates, %d of %d rows after merging, in %d ms (upsert queue remaining: %d)',
+                          batch.items,
+                          batch.rows,
+                          batch.rows_in,
+                          (time.time() - started) * 1000,
                           q.qsize())
                 if q.qsize() > 50:
                     log.warning("DB queue is > 50 (@%d); try increasing --db-threads", q.qsize())
@@ -1219,51 +1680,77 @@ def db_updater(args, q):
             log.exception('Exception in db_updater: %s', e)
 
 
+def expire_lures(condition):
+    # Like a write, the tiles of those stops get new versions.
+    stops = list(Pokestop.select(Pokestop.latitude, Pokestop.longitude).where(condition).dicts())
+    rows = (Pokestop
+            .update(lure_expiration=None, active_fort_modifier=None)
+            .where(condition)
+            .execute())
+    tile_cache.invalidate('pokestop', stops)
+    return rows
+
+
 def clean_db_loop(args):
     while True:
         try:
+            started = time.time()
+            now = datetime.utcnow()
+            rows = 0
+
             # Clean out old scanned locations.
-            query = (ScannedLocation
-                     .delete()
-                     .where((ScannedLocation.last_modified <
-                             (datetime.utcnow() - timedelta(minutes=30)))))
-            query.execute()
-
-            query = (MainWorker
-                     .delete()
-                     .where((ScannedLocation.last_modified <
-                             (datetime.utcnow() - timedelta(minutes=30)))))
-            query.execute()
-
-            query = (WorkerStatus
-                     .delete()
-                     .where((ScannedLocation.last_modified <
-                             (datetime.utcnow() - timedelta(minutes=30)))))
-            query.execute()
+            rows += db_cleaner.expire('scanned', ScannedLocation.last_modified, now - timedelta(minutes=30),
+                                      lambda condition: ScannedLocation.delete().where(condition).execute())
+
+            # And the workers that stopped reporting.
+            rows += db_cleaner.expire('main_workers', MainWorker.last_modified, now - timedelta(minutes=30),
+                                      lambda condition: MainWorker.delete().where(condition).execute())
+            rows += db_cleaner.expire('workers', WorkerStatus.last_modified, now - timedelta(minutes=30),
+                                      lambda condition: WorkerStatus.delete().where(condition).execute())
 
             # Remove active modifier from expired lured pokestops.
-            query = (Pokestop
-                     .update(lure_expiration=None, active_fort_modifier=None)
-                     .where(Pokestop.lure_expiration < datetime.utcnow()))
-            query.execute()
+            rows += db_cleaner.expire('lures', Pokestop.lure_expiration, now, expire_lures)
+
+            # The hourly seen counts are only read for recent windows.
+            rows += db_cleaner.expire('seen_hours', SeenBucket.bucket, now - seen_hours_kept,
+                                      lambda condition: SeenBucket.delete().where(condition).execute(),
+                                      where=SeenBucket.span == 'h')
+            rows += db_cleaner.expire('counted', CountedEncounter.disappear_time, now - counted_kept,
+                                      lambda condition: CountedEncounter.delete().where(condition).execute())
+
+            # Move the despawned Pokemon out of the live table.
+            moved = history.archive(flaskDb.database, now - history_after)
+            log.debug('Moved %d despawned Pokemon to the history', moved)
+            if moved:
+                # Not which tiles they were in, so all of them.
+                tile_cache.invalidate_layer('pokemon')
 
             # If desired, clear old pokemon spawns.
             if args.purge_data > 0:
-                query = (Pokemon
-                         .delete()
-                         .where((Pokemon.disappear_time <
-                                (datetime.utcnow() - timedelta(hours=args.purge_data))) & ~(Pokemon.time_detail == 1)))
-                query.execute()
-
-            log.info('Regular database cleaning complete')
-            time.sleep(60)
+                if history.purge(flaskDb.database, now - timedelta(hours=args.purge_data)):
+                    tile_cache.invalidate_layer('pokemon')
+                # Along with the days they were counted in, also whole days only.
+                rows += db_cleaner.expire('seen_days', SeenBucket.bucket, now - timedelta(hours=args.purge_data, days=1),
+                                          lambda condition: SeenBucket.delete().where(condition).execute(),
+                                          where=SeenBucket.span == 'd')
+                rows += db_cleaner.expire('appearance_days', AppearanceBucket.day,
+                                          now - timedelta(hours=args.purge_data, days=1),
+                                          lambda condition: AppearanceBucket.delete().where(condition).execute())
+
+            seconds = time.time() - started
+            log.info('Regular database cleaning complete: %d rows cleaned and %d Pokemon moved in %.1f seconds (%d rows/s)',
+                     rows, moved, seconds, (rows + moved) / seconds if seconds else 0)
         except Exception as e:
             log.exception('Exception in clean_db_loop: %s', e)
+        # Also after a failure, rather than retrying in a tight loop.
+        time.sleep(60)
 
 
-def bulk_upsert(cls, data):
+def bulk_upsert(cls, data, notify=True):
+    # Returns the rows that made it into the database.
     num_rows = len(data.values())
     i = 0
+    written = []
 
     if args.db_type == 'mysql':
         step = 120
@@ -1274,25 +1761,190 @@ def bulk_upsert(cls, data):
 
     while i < num_rows:
         log.debug('Inserting items %d to %d', i, min(i + step, num_rows))
+        rows = data.values()[i:min(i + step, num_rows)]
+        rows = upsert_chunk(cls, rows)
+        if notify and rows:
+            upserted(cls, rows)
+        written.extend(rows)
+        i += step
+
+    return written
+
+
+# Attempts per batch and chunk while the database is unavailable, the first delay between them (doubling
+# each time) and the longest one.
+upsert_retries = 5
+upsert_backoff = 0.1
+upsert_max_backoff = 30
+
+# MySQL errors that say nothing about the rows: too many connections, server shutdown, lock wait
+# timeout, deadlock, and the connection failing or getting lost.
+transient_codes = (1040, 1053, 1205, 1213, 2002, 2003, 2006, 2013)
+
+
+def transient(error):
+    # Whether the same write may well succeed when tried again.
+    if not isinstance(error, (OperationalError, InterfaceError)):
+        return False
+    if isinstance(error, InterfaceError) or 'locked' in str(error):
+        return True
+    return bool(error.args) and error.args[0] in transient_codes
+
+
+def upsert_chunk(cls, rows):
+    # Returns the rows that could be written.
+    if flaskDb.database.transaction_depth():
+        # Part of the caller's transaction, which a failure may have rolled back as a whole.
+        InsertQuery(cls, rows=rows).upsert().execute()
+        return rows
+
+    delay = upsert_backoff
+    attempt = 1
+    while True:
         try:
-            InsertQuery(cls, rows=data.values()[i:min(i + step, num_rows)]).upsert().execute()
+            with flaskDb.database.atomic():
+                InsertQuery(cls, rows=rows).upsert().execute()
+            return rows
         except Exception as e:
-            log.warning('%s... Retrying', e)
-            continue
-
-        i += step
+            error = e
+            if not transient(e):
+                break
+            if attempt == upsert_retries:
+                raise
+        db_updater_stats.count('retries')
+        log.warning('%s... Retrying in %.1f seconds', error, delay)
+        time.sleep(delay)
+        delay *= 2
+        attempt += 1
+
+    if len(rows) > 1:
+        # Isolate the rows that can't be written.
+        db_updater_stats.count('bisections')
+        half = len(rows) / 2
+        return upsert_chunk(cls, rows[:half]) + upsert_chunk(cls, rows[half:])
+
+    db_updater_stats.count('dead_letters')
+    log.error('Giving up on a %s row, writing it to %s: %s', cls.__name__, args.dead_letter_file, error)
+    dead_letters.write(cls.__name__, rows, error)
+    return []
+
+
+def replay_dead_letters():
+    queued_models = dict((m.__name__, m) for m in (Pokemon, Pokestop, Gym, ScannedLocation, MainWorker, WorkerStatus,
+                                                   GymDetails, GymMember, GymPokemon, Trainer))
+
+    def upsert(model_name, rows):
+        bulk_upsert(queued_models[model_name], dict(enumerate(rows)))
+
+    count = dead_letters.replay(upsert)
+    log.info('Replayed %d rows from %s', count, args.dead_letter_file)
+
+
+def upserted(cls, rows):
+    # Keep the in-memory views in step with what just got written.
+    try:
+        if cls is Pokemon:
+            # Only count encounters the first time anyone writes them.
+            keys = [(p['encounter_id'], p['spawnpoint_id']) for p in rows]
+            counted = seen_encounters.known(keys)
+            unknown = [p for key, p in zip(keys, rows) if key not in counted]
+            if unknown:
+                try:
+                    # All or nothing, what failed is counted with its next write.
+                    with flaskDb.database.atomic():
+                        new = CountedEncounter.claim(unknown)
+                        if new:
+                            SeenBucket.add(SeenBucket.aggregate(new))
+                            AppearanceBucket.add(AppearanceBucket.aggregate(new))
+                except Exception as e:
+                    # Best effort, the rows themselves are written already.
+                    log.exception('Counting %d Pokemon in the statistics failed: %s', len(unknown), e)
+                else:
+                    grace = datetime.utcnow() + timedelta(hours=1)
+                    seen_encounters.add_all(((p['encounter_id'], p['spawnpoint_id']), max(p['disappear_time'], grace))
+                                            for p in unknown)
+
+            known_encounters.add_all(((p['encounter_id'], p['spawnpoint_id']), p['disappear_time']) for p in rows)
+            if active_pokemon.ready:
+                active_pokemon.update(rows)
+            try:
+                if spawnpoints.ready:
+                    changed = spawnpoints.observe(rows)
+                    if changed:
+                        bulk_upsert(Spawnpoint, dict(enumerate(changed)))
+                else:
+                    # Without the memory index, straight from the table.
+                    Spawnpoint.observe(rows)
+            except Exception as e:
+                # Written with the next change of those spawnpoints.
+                log.exception('Updating the spawnpoints of %d Pokemon failed: %s', len(rows), e)
+
+        if change_log.enabled and cls in change_log_kinds:
+            kind, key_fields, stamp = change_log_kinds[cls]
+            now = datetime.utcnow()
+            changed = []
+            for row in rows:
+                row = dict(row)
+                # Mirror the column default the database just filled in.
+                if row.get(stamp) is None:
+                    row[stamp] = now
+                changed.append(row)
+            change_log.append(kind, key_fields, changed)
+    finally:
+        # Last, also if a view failed: the new versions make ETags change,
+        # and whoever gets one must also get the rows from every view and
+        # the change log. The tiles are reloaded from the database.
+        if cls in tile_layers:
+            tile_cache.invalidate(tile_layers[cls], rows)
+        elif cls in gym_detail_models:
+            # Can't tell where those are, so every gym tile goes.
+            tile_cache.invalidate_layer('gym')
+
+
+# Layers the map client can follow through the change log.
+change_log_kinds = {
+    Pokemon: ('pokemon', ('encounter_id',), 'last_modified'),
+    Pokestop: ('pokestop', ('pokestop_id',), 'last_updated'),
+    Gym: ('gym', ('gym_id',), 'last_scanned'),
+    ScannedLocation: ('scanned', ('latitude', 'longitude'), 'last_modified'),
+}
+
+
+# Layers of the tile cache, see app.Pogom.from_tiles and app.Pogom.etag.
+tile_layers = {
+    Pokemon: 'pokemon',
+    Pokestop: 'pokestop',
+    Gym: 'gym',
+    ScannedLocation: 'scanned',
+    # Not cached, only versioned for conditional requests.
+    Spawnpoint: 'spawnpoint',
+}
+
+gym_detail_models = (GymDetails, GymMember, GymPokemon, Trainer)
+
+
+# Past Pokemon, by the day they disappeared on, and how long after that they move there.
+history = HistoryPartitions(Pokemon, args.db_type)
+history_after = timedelta(minutes=15)
+
+# Tables with a spatial index next to their (latitude, longitude) one.
+geo_models = (Pokemon, Pokestop, Gym, ScannedLocation)
 
 
 def create_tables(db):
     db.connect()
     verify_database_schema(db)
-    db.create_tables([Pokemon, Pokestop, Gym, ScannedLocation, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus], safe=True)
+    db.create_tables([Pokemon, Pokestop, Gym, ScannedLocation, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus, Spawnpoint, SeenBucket, AppearanceBucket, CountedEncounter], safe=True)
+    geo_index.setup(db, args.db_type, geo_models)
+    history.setup(db)
     db.close()
 
 
 def drop_tables(db):
     db.connect()
-    db.drop_tables([Pokemon, Pokestop, Gym, ScannedLocation, Versions, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus, Versions], safe=True)
+    geo_index.drop(db, args.db_type, geo_models)
+    history.drop(db)
+    db.drop_tables([Pokemon, Pokestop, Gym, ScannedLocation, Versions, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus, Spawnpoint, SeenBucket, AppearanceBucket, CountedEncounter, Versions], safe=True)
     db.close()
 
 
@@ -1322,6 +1974,59 @@ def verify_database_schema(db):
             sys.exit(1)
 
 
+def backfill_spawnpoints():
+    # Learn the spawnpoint timings from the Pokemon history, in the order they were seen.
+    log.info('Building the spawnpoint table from the Pokemon history, this may take a while...')
+    table = SpawnpointTable()
+    table.ready = True
+    query = (Pokemon
+             .select(Pokemon.encounter_id, Pokemon.spawnpoint_id, Pokemon.latitude, Pokemon.longitude,
+                     Pokemon.disappear_time, Pokemon.last_modified, Pokemon.time_detail)
+             .order_by(Pokemon.last_modified)
+             .dicts())
+    for p in query.iterator():
+        table.observe([p])
+    Spawnpoint.delete().execute()
+    bulk_upsert(Spawnpoint, dict(enumerate(table.rows.values())), notify=False)
+    log.info('Found %d spawnpoints with known timings', len(table))
+
+
+def backfill_seen_buckets():
+    log.info('Counting the Pokemon history into the seen statistics, this may take a while...')
+    query = (Pokemon
+             .select(Pokemon.pokemon_id, Pokemon.disappear_time, Pokemon.latitude, Pokemon.longitude)
+             .dicts())
+    totals = {}
+    for p in query.iterator():
+        SeenBucket.aggregate([p], totals)
+    SeenBucket.add(totals)
+
+
+def backfill_appearance_buckets():
+    log.info('Counting the Pokemon history into the appearance statistics, this may take a while...')
+    query = (Pokemon
+             .select(Pokemon.pokemon_id, Pokemon.spawnpoint_id, Pokemon.disappear_time,
+                     Pokemon.latitude, Pokemon.longitude)
+             .dicts())
+    totals = {}
+    for p in query.iterator():
+        AppearanceBucket.aggregate([p], totals)
+    AppearanceBucket.add(totals)
+
+
+def backfill_counted_encounters():
+    # What may still be rewritten is in the counts already.
+    db = flaskDb.database
+    cutoff = datetime.utcnow() - counted_kept
+    for model in history.models_since(db, cutoff):
+        sql, params = (model
+                       .select(model.encounter_id, model.disappear_time)
+                       .where(model.disappear_time > cutoff)
+                       .sql())
+        db.execute_sql('{} INTO countedencounter (encounter_id, disappear_time) {}'.format(
+            CountedEncounter.insert_ignore(), sql), params)
+
+
 def database_migrate(db, old_ver):
     # Update database schema version.
     Versions.update(val=db_schema_version).where(Versions.key == 'schema_version').execute()
@@ -1390,3 +2095,47 @@ def database_migrate(db, old_ver):
         migrate(
             migrator.add_column('pokemon', 'time_detail', IntegerField(default=-1, index=True))
         )
+
+    if old_ver < 11:
+        db.create_tables([Spawnpoint], safe=True)
+    elif old_ver < 12:
+        migrate(
+            migrator.add_column('spawnpoint', 'latitude', DoubleField(null=True)),
+            migrator.add_column('spawnpoint', 'longitude', DoubleField(null=True)),
+            migrator.add_column('spawnpoint', 'count', IntegerField(default=0)),
+            migrator.add_column('spawnpoint', 'special', BooleanField(default=False)),
+            migrator.add_column('spawnpoint', 'time_detail', IntegerField(default=-1)),
+            migrator.add_index('spawnpoint', ('latitude', 'longitude'), False)
+        )
+
+    if old_ver < 12:
+        backfill_spawnpoints()
+
+    if old_ver < 13:
+        db.create_tables([SeenBucket], safe=True)
+        backfill_seen_buckets()
+
+    if old_ver < 14:
+        db.create_tables([AppearanceBucket], safe=True)
+        backfill_appearance_buckets()
+
+    if old_ver < 15:
+        log.info('Moving the Pokemon history out of the live table, this may take a while...')
+        history.setup(db)
+        history.archive(db, datetime.utcnow() - history_after)
+
+    if 13 <= old_ver < 16 and 'seenbucket_span_bucket' not in [i.name for i in db.get_indexes('seenbucket')]:
+        # Created with it from then on.
+        migrate(
+            migrator.add_index('seenbucket', ('span', 'bucket'), False)
+        )
+
+    if old_ver < 17:
+        db.create_tables([CountedEncounter], safe=True)
+        backfill_counted_encounters()
+
+    if 14 <= old_ver < 18 and 'appearancebucket_day' not in [i.name for i in db.get_indexes('appearancebucket')]:
+        # Created with it from then on.
+        migrate(
+            migrator.add_index('appearancebucket', ('day',), False)
+        )
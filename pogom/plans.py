@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+
+class Markers(object):
+    '''
+    Stand-ins for a query's parameters while its SQL is generated. Each is a
+    value of the right type that no real query uses, so it can be found
+    again among the generated parameters.
+    '''
+
+    def __init__(self):
+        self.slots = {}
+
+    def float(self, name):
+        value = 987654321.0 + len(self.slots) + 0.25
+        self.slots[value] = (name, float)
+        return value
+
+    def datetime(self, name):
+        value = datetime(1900, 1, 1, 0, 0, 0, len(self.slots) + 1)
+        self.slots[value] = (name, None)
+        return value
+
+
+class Plan(object):
+
+    def __init__(self, model, sql, params):
+        self.model = model
+        self.sql = sql
+        # (name, convert) for request parameters, (None, value) for constants.
+        self.params = params
+
+    def execute(self, **values):
+        params = []
+        for name, value in self.params:
+            if name is None:
+                params.append(value)
+            else:
+                params.append(value(values[name]) if value else values[name])
+        return self.model.raw(self.sql, *params).dicts()
+
+
+class PlanCache(object):
+    '''
+    SQL of the queries the map repeats on every poll, generated once per
+    query shape. Requests only bind their parameters, and the unchanging
+    SQL text lets drivers with a statement cache (sqlite3) reuse the
+    prepared statement.
+    '''
+
+    def __init__(self):
+        self.plans = {}
+
+    def get(self, shape, build):
+        '''
+        The plan for `shape`, built from the peewee query build(markers)
+        returns on first use.
+        '''
+        plan = self.plans.get(shape)
+        if plan is not None:
+            return plan
+
+        markers = Markers()
+        query = build(markers)
+        sql, values = query.sql()
+        params = []
+        found = set()
+        for value in values:
+            try:
+                slot = markers.slots.get(value)
+            except TypeError:
+                slot = None
+            if slot is None:
+                params.append((None, value))
+            else:
+                params.append(slot)
+                found.add(slot[0])
+
+        missing = set(name for name, convert in markers.slots.values()) - found
+        if missing:
+            raise ValueError('Parameters {} of query {} got lost.'.format(sorted(missing), shape))
+
+        plan = self.plans[shape] = Plan(query.model_class, sql, params)
+        log.debug('Compiled query %s: %s', shape, sql)
+        return plan
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import calendar
+import json
+import logging
+
+from threading import Lock
+from queue import Queue, Full, Empty
+
+from .spatial import in_bounds
+from .transform import transform_from_wgs_to_gcj
+from .utils import get_args, get_pokemon_name, get_pokemon_rarity, get_pokemon_types
+
+log = logging.getLogger(__name__)
+
+
+class Subscriber(object):
+
+    def __init__(self, bounds, maxsize):
+        self.bounds = bounds
+        self.queue = Queue(maxsize)
+
+
+class PushChannel(object):
+    '''
+    Pushes new Pokemon, lure changes and gym changes to the map clients that
+    are subscribed to the viewport they happened in.
+
+    It follows the map events on the event bus and turns them into the rows
+    the map already knows from raw_data. Clients that fall too far behind get
+    a "reload" event and poll raw_data instead.
+    '''
+
+    def __init__(self, maxsize=500):
+        self.maxsize = maxsize
+        self.subscribers = []
+        self.lock = Lock()
+        # Last known state of the forts, so we only push actual changes.
+        self.lures = {}
+        self.gyms = {}
+
+    def subscribe(self, bounds=None):
+        sub = Subscriber(bounds, self.maxsize)
+        with self.lock:
+            self.subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+
+    def run(self, sub):
+        # Consumes the push channel's subscription on the event bus.
+        while True:
+            try:
+                batch = sub.queue.get()
+                for event in batch:
+                    self.publish(event)
+                sub.queue.task_done()
+            except Exception as e:
+                log.exception('Exception in push updater: %s', e)
+
+    def publish(self, event):
+        row = self._to_map_row(event)
+        if row is None:
+            return
+
+        data = json.dumps(row)
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for sub in subscribers:
+            if sub.bounds is not None and not in_bounds(row['latitude'], row['longitude'], sub.bounds):
+                continue
+            try:
+                sub.queue.put_nowait((event.kind, data))
+            except Full:
+                self._overflow(sub)
+
+    def _overflow(self, sub):
+        # Whatever is queued is stale by now; tell the client to reload instead.
+        try:
+            while True:
+                sub.queue.get_nowait()
+        except Empty:
+            pass
+        sub.queue.put_nowait(('reload', '{}'))
+
+    def _to_map_row(self, event):
+        source = event.row
+        if event.kind == 'pokemon':
+            row = dict(source)
+            row['disappear_time'] = calendar.timegm(source['disappear_time'].timetuple()) * 1000
+            row['last_modified'] = event.timestamp_ms
+            row['pokemon_name'] = get_pokemon_name(source['pokemon_id'])
+            row['pokemon_rarity'] = get_pokemon_rarity(source['pokemon_id'])
+            row['pokemon_types'] = get_pokemon_types(source['pokemon_id'])
+
+        elif event.kind == 'pokestop':
+            stop_id = source['pokestop_id']
+            if source['lure_expiration'] is None:
+                self.lures.pop(stop_id, None)
+                return None
+            if self.lures.get(stop_id) == source['lure_expiration']:
+                return None
+            self.lures[stop_id] = source['lure_expiration']
+            row = {
+                'pokestop_id': stop_id,
+                'enabled': source['enabled'],
+                'latitude': source['latitude'],
+                'longitude': source['longitude'],
+                'last_modified': event.timestamp_ms,
+                'lure_expiration': calendar.timegm(source['lure_expiration'].timetuple()) * 1000,
+                'active_fort_modifier': source['active_fort_modifier'],
+            }
+
+        elif event.kind == 'gym':
+            state = (source['team_id'], source['guard_pokemon_id'], source['gym_points'])
+            if self.gyms.get(source['gym_id']) == state:
+                return None
+            self.gyms[source['gym_id']] = state
+            row = {
+                'gym_id': source['gym_id'],
+                'team_id': source['team_id'],
+                'guard_pokemon_id': source['guard_pokemon_id'],
+                'gym_points': source['gym_points'],
+                'enabled': source['enabled'],
+                'latitude': source['latitude'],
+                'longitude': source['longitude'],
+                'last_modified': event.timestamp_ms,
+            }
+
+        else:
+            return None
+
+        if get_args().china:
+            row['latitude'], row['longitude'] = \
+                transform_from_wgs_to_gcj(row['latitude'], row['longitude'])
+
+        return row
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import itertools
+import logging
+import time
+
+from contextlib import contextmanager
+from threading import Lock, local
+
+from peewee import DatabaseError, InterfaceError
+
+log = logging.getLogger(__name__)
+
+
+class ReplicaRouter(object):
+    '''
+    Sends the reads of web requests to MySQL replicas, so the map doesn't
+    compete with the db updaters for the primary.
+
+    A replica is only used while it is at most `max_lag` seconds behind,
+    checked at most every `check_interval` seconds. Without a replica that
+    qualifies, inside a transaction, for anything but a SELECT, and when a
+    replica fails mid-request, queries go to the primary as before.
+    '''
+
+    def __init__(self, max_lag=10, check_interval=5):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.replicas = []
+        self.cycle = None
+        self.local = local()
+        self.lock = Lock()
+        # Replica: (time checked, seconds behind or None if unusable)
+        self.lags = {}
+        self.routed = 0
+        self.fallbacks = 0
+
+    def init(self, replicas):
+        self.replicas = list(replicas)
+        self.cycle = itertools.cycle(self.replicas)
+
+    def begin(self):
+        # Picks the replica this thread reads from until end().
+        self.local.replica = None
+        for _ in range(len(self.replicas)):
+            with self.lock:
+                replica = next(self.cycle)
+            lag = self._lag(replica)
+            if self._usable(lag):
+                self.local.replica = replica
+                break
+
+    def end(self, exc=None):
+        # Reads go to the primary from here on.
+        replica = getattr(self.local, 'replica', None)
+        self.local.replica = None
+        if replica is not None and not replica.is_closed():
+            replica.close()
+
+    @contextmanager
+    def primary(self):
+        # Reads in here see everything written so far.
+        replica = getattr(self.local, 'replica', None)
+        self.local.replica = None
+        try:
+            yield
+        finally:
+            self.local.replica = replica
+
+    def staleness(self):
+        # Seconds the data this thread reads may be behind at most: the lag
+        # allowed, rounded up to whole seconds as MySQL reports it, plus how
+        # much it can have grown since it was checked.
+        if getattr(self.local, 'replica', None) is None:
+            return 0
+        return self.max_lag + 1 + self.check_interval
+
+    def execute(self, primary, sql, params):
+        '''
+        Runs sql on this thread's replica if it may go there and returns
+        the cursor, or returns None for the primary to run it.
+        '''
+        replica = getattr(self.local, 'replica', None)
+        if replica is None or primary.transaction_depth():
+            return None
+        words = sql.lstrip()[:6].upper()
+        if words != 'SELECT' or sql.rstrip().upper().endswith('FOR UPDATE'):
+            return None
+
+        try:
+            cursor = replica.execute_sql(sql, params, require_commit=False)
+        except (DatabaseError, InterfaceError) as e:
+            log.warning('Reading from a replica failed, using the primary: %s', e)
+            self.end()
+            with self.lock:
+                self.lags[replica] = (time.time(), None)
+                self.fallbacks += 1
+            return None
+        with self.lock:
+            self.routed += 1
+        return cursor
+
+    def _lag(self, replica):
+        with self.lock:
+            checked, lag = self.lags.get(replica, (0, None))
+            if time.time() - checked < self.check_interval:
+                return lag
+            # Other threads keep using the last result meanwhile.
+            self.lags[replica] = (time.time(), lag)
+
+        try:
+            cursor = replica.execute_sql('SHOW SLAVE STATUS', require_commit=False)
+            row = cursor.fetchone()
+            columns = [c[0] for c in cursor.description or ()]
+            # Not replicating at all, or the SQL thread stopped.
+            lag = dict(zip(columns, row)).get('Seconds_Behind_Master') if row else None
+        except (DatabaseError, InterfaceError) as e:
+            log.warning('Could not check the replication lag of a replica: %s', e)
+            lag = None
+            if not replica.is_closed():
+                replica.close()
+
+        with self.lock:
+            previous = self.lags[replica][1]
+            self.lags[replica] = (time.time(), lag)
+        if self._usable(previous) != self._usable(lag):
+            if self._usable(lag):
+                log.info('Reading from a replica, %d seconds behind', lag)
+            else:
+                log.warning('Not reading from a replica, it is %s', 'not replicating' if lag is None
+                            else '{} seconds behind'.format(lag))
+        return lag
+
+    def _usable(self, lag):
+        return lag is not None and lag <= self.max_lag
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'replicas': len(self.replicas),
+                'lags': [self.lags.get(r, (0, None))[1] for r in self.replicas],
+                'routed': self.routed,
+                'fallbacks': self.fallbacks,
+            }
+
+
+class ReplicaRouting(object):
+    '''
+    For the primary database: reads go through the router first.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.router = kwargs.pop('router', None)
+        super(ReplicaRouting, self).__init__(*args, **kwargs)
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        cursor = self.router.execute(self, sql, params) if self.router is not None else None
+        if cursor is None:
+            cursor = super(ReplicaRouting, self).execute_sql(sql, params, require_commit)
+        return cursor
@@ -35,7 +35,7 @@ from pgoapi.utilities import f2i
 from pgoapi import utilities as util
 from pgoapi.exceptions import AuthException
 
-from .models import parse_map, GymDetails, parse_gyms, MainWorker, WorkerStatus
+from .models import parse_map, GymDetails, parse_gyms, MainWorker, WorkerStatus, db_connections
 from .fakePogoApi import FakePogoApi
 from .utils import now
 from .transform import get_new_coords
@@ -228,7 +228,8 @@ def account_recycler(accounts_queue, account_failures, args):
 
 def worker_status_db_thread(threads_status, name, db_updates_queue):
     log.info("Clearing previous statuses for '%s' worker", name)
-    WorkerStatus.delete().where(WorkerStatus.worker_name == name).execute()
+    with db_connections.reading():
+        WorkerStatus.delete().where(WorkerStatus.worker_name == name).execute()
 
     while True:
         workers = {}
@@ -672,7 +673,8 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                         if distance < 1:
                             # Check if we already have details on this gym. (if not, get them)
                             try:
-                                record = GymDetails.get(gym_id=gym['gym_id'])
+                                with db_connections.reading():
+                                    record = GymDetails.get(gym_id=gym['gym_id'])
                             except GymDetails.DoesNotExist as e:
                                 gyms_to_update[gym['gym_id']] = gym
                                 continue
@@ -711,7 +713,8 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                         log.debug(status['message'])
 
                         if gym_responses:
-                            parse_gyms(args, gym_responses, whq)
+                            with db_connections.reading():
+                                parse_gyms(args, gym_responses, whq)
 
                 # Record the time and place the worker left off at.
                 status['last_scan_time'] = now()
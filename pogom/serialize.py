@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import itertools
+import json
+import logging
+import zlib
+
+from collections import Iterator
+from datetime import datetime
+
+try:
+    import ujson as fast_json
+except ImportError:
+    fast_json = None
+
+log = logging.getLogger(__name__)
+
+epoch = datetime(1970, 1, 1)
+
+# Rows per piece when streaming a list.
+chunk_rows = 500
+
+# Values convert() has to look into.
+containers = (datetime, dict, list)
+
+
+def to_millis(dt):
+    if dt.utcoffset() is not None:
+        dt = (dt - dt.utcoffset()).replace(tzinfo=None)
+    delta = dt - epoch
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+
+def millis(values):
+    # A whole column at once; only aware datetimes need the slow path.
+    result = []
+    append = result.append
+    for v in values:
+        if v is None:
+            append(None)
+        elif v.tzinfo is None:
+            delta = v - epoch
+            append((delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000)
+        else:
+            append(to_millis(v))
+    return result
+
+
+def convert(value):
+    '''
+    Replaces the datetimes in nested dicts and lists with epoch milliseconds,
+    in place, so the result serializes without calling back into Python for
+    every value. Lists are taken to hold one type, their first item decides
+    whether they need a look.
+    '''
+    cls = value.__class__
+    if cls is datetime:
+        return to_millis(value)
+    if cls is dict:
+        for key, item in value.iteritems():
+            if item.__class__ in containers:
+                value[key] = convert(item)
+    elif cls is list and value and value[0].__class__ in containers:
+        for i, item in enumerate(value):
+            value[i] = convert(item)
+    return value
+
+
+def default(obj):
+    # Whatever wasn't converted up front: datetimes and other iterables.
+    if isinstance(obj, datetime):
+        return to_millis(obj)
+    try:
+        iterable = iter(obj)
+    except TypeError:
+        raise TypeError(repr(obj) + ' is not JSON serializable')
+    return list(iterable)
+
+
+def dumps(obj):
+    if fast_json is not None:
+        try:
+            return fast_json.dumps(obj, double_precision=15)
+        except (TypeError, OverflowError):
+            pass
+    return json.dumps(obj, default=default, separators=(',', ':'))
+
+
+def iter_json(d):
+    '''
+    Encodes a dict piece by piece, lists and iterators `chunk_rows` items at
+    a time, so a big response never exists as one string. Iterators are
+    only read while the response is being sent.
+    '''
+    yield '{'
+    first = True
+    for key, value in d.iteritems():
+        yield ('' if first else ',') + dumps(key) + ':'
+        first = False
+        if isinstance(value, list) and len(value) > chunk_rows:
+            yield '['
+            for i in range(0, len(value), chunk_rows):
+                yield (',' if i else '') + dumps(value[i:i + chunk_rows])[1:-1]
+            yield ']'
+        elif isinstance(value, Iterator):
+            # A generator or query still being read; convert as it comes.
+            yield '['
+            sep = ''
+            while True:
+                chunk = list(itertools.islice(value, chunk_rows))
+                if not chunk:
+                    break
+                yield sep + dumps(convert(chunk))[1:-1]
+                sep = ','
+            yield ']'
+        else:
+            yield dumps(value)
+    yield '}'
+
+
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        # Templates render to text.
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
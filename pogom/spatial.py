@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import math
+
+from datetime import datetime
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+def in_bounds(lat, lng, bounds):
+    swLat, swLng, neLat, neLng = bounds
+    return swLat <= lat <= neLat and swLng <= lng <= neLng
+
+
+def bounds_difference(bounds, exclude):
+    '''
+    The part of bounds outside exclude as at most four rectangles: the full
+    width strips below and above exclude, and the pieces left and right of
+    it in between. Neighbouring rectangles share their edges.
+    '''
+    swLat, swLng, neLat, neLng = bounds
+    oSwLat, oSwLng, oNeLat, oNeLng = exclude
+    lo, hi = max(swLat, oSwLat), min(neLat, oNeLat)
+    if lo > hi or max(swLng, oSwLng) > min(neLng, oNeLng):
+        # No overlap, nothing to cut out.
+        return [bounds]
+
+    rects = []
+    if oSwLat > swLat:
+        rects.append((swLat, swLng, oSwLat, neLng))
+    if oNeLat < neLat:
+        rects.append((oNeLat, swLng, neLat, neLng))
+    if oSwLng > swLng:
+        rects.append((lo, swLng, hi, oSwLng))
+    if oNeLng < neLng:
+        rects.append((lo, oNeLng, hi, neLng))
+    return rects
+
+
+def query_difference(query, bounds, exclude):
+    '''
+    Yields the rows query(rect) returns for each rectangle of
+    bounds_difference(), each row once and none inside exclude, which is
+    what "in bounds but not in exclude" asks for with plain range queries.
+    '''
+    rects = bounds_difference(bounds, exclude)
+    for i, rect in enumerate(rects):
+        for row in query(rect):
+            lat, lng = row['latitude'], row['longitude']
+            if in_bounds(lat, lng, exclude):
+                continue
+            # On an edge shared with a rectangle already done.
+            if any(in_bounds(lat, lng, r) for r in rects[:i]):
+                continue
+            yield row
+
+
+class GridIndex(object):
+    '''
+    Buckets items into a fixed lat/lng grid, so a viewport lookup only has to
+    look at the cells it overlaps instead of at every item we know about.
+
+    Not thread safe on its own; callers are expected to hold a lock.
+    '''
+
+    def __init__(self, cell_size=0.01):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.items = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def _cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lng / self.cell_size)))
+
+    def get(self, key):
+        entry = self.items.get(key)
+        return entry[1] if entry is not None else None
+
+    def add(self, key, lat, lng, item):
+        self.remove(key)
+        cell = self._cell(lat, lng)
+        self.cells.setdefault(cell, {})[key] = (lat, lng, item)
+        self.items[key] = (cell, item)
+
+    def remove(self, key):
+        entry = self.items.pop(key, None)
+        if entry is None:
+            return None
+        bucket = self.cells[entry[0]]
+        del bucket[key]
+        if not bucket:
+            del self.cells[entry[0]]
+        return entry[1]
+
+    def values(self):
+        return [entry[1] for entry in self.items.values()]
+
+    def within(self, bounds):
+        # Yields every item inside bounds (swLat, swLng, neLat, neLng).
+        swCell = self._cell(bounds[0], bounds[1])
+        neCell = self._cell(bounds[2], bounds[3])
+        num_cells = (neCell[0] - swCell[0] + 1) * (neCell[1] - swCell[1] + 1)
+
+        # Zoomed far out it's cheaper to walk the populated cells than the grid.
+        if num_cells > len(self.cells):
+            buckets = self.cells.values()
+        else:
+            buckets = []
+            for x in range(swCell[0], neCell[0] + 1):
+                for y in range(swCell[1], neCell[1] + 1):
+                    bucket = self.cells.get((x, y))
+                    if bucket:
+                        buckets.append(bucket)
+
+        for bucket in buckets:
+            for lat, lng, item in bucket.values():
+                if in_bounds(lat, lng, bounds):
+                    yield item
+
+
+class ActivePokemonIndex(object):
+    '''
+    In-memory spatial index of the Pokemon that haven't despawned yet.
+
+    It is fed with the same rows db_updater writes to the database and drops
+    entries once their disappear_time has passed, so viewport queries for live
+    Pokemon never need to reach the database. Until load() has been called
+    the index is not ready and callers should fall back to the database.
+    '''
+
+    def __init__(self, cell_size=0.01):
+        self.index = GridIndex(cell_size)
+        self.expiry = []
+        self.lock = Lock()
+        self.ready = False
+
+    def __len__(self):
+        return len(self.index)
+
+    def load(self, rows):
+        with self.lock:
+            for row in rows:
+                self._add(row, datetime.utcnow())
+            self.ready = True
+        log.info('Loaded %d active Pokemon into the memory index', len(self.index))
+
+    def update(self, rows):
+        now = datetime.utcnow()
+        with self.lock:
+            self._expire(now)
+            for row in rows:
+                self._add(row, now)
+
+    def query(self, bounds=None, since=None, exclude=None, ids=None):
+        now = datetime.utcnow()
+        with self.lock:
+            self._expire(now)
+            if bounds is None:
+                rows = self.index.values()
+            elif exclude is not None:
+                rows = query_difference(self.index.within, bounds, exclude)
+            else:
+                rows = self.index.within(bounds)
+
+            results = []
+            for row in rows:
+                if since is not None and row['last_modified'] <= since:
+                    continue
+                if ids is not None and row['pokemon_id'] not in ids:
+                    continue
+                # Callers decorate the rows they get back; hand out copies.
+                results.append(dict(row))
+
+        return results
+
+    def iter_all(self):
+        # Like query() without filters, but copies each row only as it is
+        # consumed. Stored rows are replaced, never changed, so that's safe.
+        now = datetime.utcnow()
+        with self.lock:
+            self._expire(now)
+            rows = self.index.values()
+        for row in rows:
+            if row['disappear_time'] > now:
+                yield dict(row)
+
+    def _add(self, row, now):
+        if row['disappear_time'] <= now:
+            self.index.remove(row['encounter_id'])
+            return
+
+        row = dict(row)
+        if row.get('last_modified') is None:
+            row['last_modified'] = now
+        self.index.add(row['encounter_id'], row['latitude'], row['longitude'], row)
+        heapq.heappush(self.expiry, (row['disappear_time'], row['encounter_id']))
+
+    def _expire(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            disappear_time, encounter_id = heapq.heappop(self.expiry)
+            row = self.index.get(encounter_id)
+            # A re-sighting may have pushed the disappear_time back since.
+            if row is not None and row['disappear_time'] <= now:
+                self.index.remove(encounter_id)
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from datetime import datetime, timedelta
+from threading import Lock
+
+from .expiring import ExpiringSet
+from .spatial import GridIndex, query_difference
+
+log = logging.getLogger(__name__)
+
+
+def seconds_of_hour(dt):
+    return dt.minute * 60 + dt.second
+
+
+def same_second(a, b, tolerance=5):
+    # Compares seconds of the hour, wrapping around at the full hour.
+    diff = abs(a - b) % 3600
+    return min(diff, 3600 - diff) <= tolerance
+
+
+class SpawnpointTable(object):
+    '''
+    In-memory copy of the Spawnpoint table, kept current from the Pokemon
+    rows the db updater writes, so predicting a disappear time is a dict
+    lookup and the spawnpoint layer a grid lookup instead of aggregating the
+    whole Pokemon history.
+
+    The despawn second is a running majority vote over the sightings;
+    confidence is its lead in that vote as a share of all samples, 1.0
+    meaning every sample agreed. Once a spawnpoint has a disappear time from
+    the server, the vote starts over with only those.
+    '''
+
+    def __init__(self, cell_size=0.01):
+        self.rows = {}
+        self.index = GridIndex(cell_size)
+        self.lock = Lock()
+        self.ready = False
+        # Each encounter only counts once, however often it was seen.
+        self.counted = ExpiringSet()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def load(self, rows):
+        with self.lock:
+            for row in rows:
+                self._store(dict(row))
+            self.ready = True
+        log.info('Loaded %d spawnpoints into memory', len(self.rows))
+
+    def despawn_sec(self, spawnpoint_id):
+        # Only trusted once the server told us.
+        with self.lock:
+            row = self.rows.get(spawnpoint_id)
+            if row is None or row['time_detail'] != 1:
+                return None
+            return row['despawn_sec']
+
+    def query(self, bounds, since=None, exclude=None):
+        with self.lock:
+            results = []
+            if bounds is None:
+                rows = self.index.values()
+            elif exclude is not None:
+                rows = query_difference(self.index.within, bounds, exclude)
+            else:
+                rows = self.index.within(bounds)
+            for row in rows:
+                if since is not None and row['last_modified'] <= since:
+                    continue
+                results.append(dict(row))
+        return results
+
+    def observe(self, pokemon, rows=None):
+        '''
+        Folds freshly written Pokemon rows into the table and returns copies
+        of the spawnpoint rows that changed, for writing back.
+
+        Without the table in memory, pass the database's rows of their
+        spawnpoints as {spawnpoint_id: row} to fold them into those instead.
+        '''
+        # An encounter counts once as a sighting and once more when it comes with a time from the server.
+        keys = [(p['encounter_id'], p) for p in pokemon]
+        keys += [((p['encounter_id'], 'timed'), p) for p in pokemon if p['time_detail'] == 1]
+        counted = self.counted.known(key for key, p in keys)
+        self.counted.add_all((key, p['disappear_time']) for key, p in keys)
+
+        now = datetime.utcnow()
+        changed = {}
+        stored = rows is None
+        with self.lock:
+            if stored:
+                rows = self.rows
+            for p in pokemon:
+                seen = p['encounter_id'] in counted
+                timed = p['time_detail'] == 1 and (p['encounter_id'], 'timed') not in counted
+                if seen and not timed:
+                    continue
+                counted.add(p['encounter_id'])
+                if timed:
+                    counted.add((p['encounter_id'], 'timed'))
+
+                row = rows.get(p['spawnpoint_id'])
+                if row is None:
+                    row = {
+                        'spawnpoint_id': p['spawnpoint_id'],
+                        'latitude': p['latitude'],
+                        'longitude': p['longitude'],
+                        'despawn_sec': None,
+                        'confidence': 0.0,
+                        'samples': 0,
+                        'count': 0,
+                        'special': False,
+                        'time_detail': -1,
+                    }
+                if not seen:
+                    row['count'] += 1
+
+                if timed:
+                    if row['time_detail'] != 1:
+                        # Forget the guesses.
+                        row['samples'] = 0
+                    # Seen more than 30 minutes before it disappears.
+                    last_modified = p.get('last_modified') or now
+                    if p['disappear_time'] - last_modified > timedelta(minutes=30):
+                        row['special'] = True
+                if timed or row['time_detail'] != 1:
+                    self._vote(row, seconds_of_hour(p['disappear_time']))
+
+                row['time_detail'] = max(row['time_detail'], p['time_detail'])
+                row['last_modified'] = now
+                if stored:
+                    self._store(row)
+                else:
+                    rows[row['spawnpoint_id']] = row
+                changed[row['spawnpoint_id']] = dict(row)
+
+        return changed.values()
+
+    def _store(self, row):
+        self.rows[row['spawnpoint_id']] = row
+        if row.get('latitude') is not None:
+            self.index.add(row['spawnpoint_id'], row['latitude'], row['longitude'], row)
+
+    @staticmethod
+    def _vote(row, sec):
+        agree = int(round(row['confidence'] * row['samples']))
+        if row['samples'] and same_second(sec, row['despawn_sec']):
+            agree += 1
+        else:
+            agree -= 1
+            if agree <= 0:
+                row['despawn_sec'] = sec
+                agree = 1
+        row['samples'] += 1
+        row['confidence'] = agree / float(row['samples'])
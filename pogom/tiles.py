@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import time
+
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+def tile_of(lat, lng, zoom):
+    # Web Mercator tile (x, y) the point falls in.
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lng + 180.0) / 360.0 * n)
+    rad = math.radians(lat)
+    y = int((1.0 - math.log(math.tan(rad) + 1.0 / math.cos(rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(x, y, zoom):
+    # (swLat, swLng, neLat, neLng) of a tile.
+    n = 2.0 ** zoom
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return (lat(y + 1), x / n * 360.0 - 180.0, lat(y), (x + 1) / n * 360.0 - 180.0)
+
+
+class TileCache(object):
+    '''
+    Map layers cut into fixed Web Mercator tiles, each loaded from the
+    database once per `ttl` seconds however many clients look at it.
+
+    A tile's content is dropped early when a row inside it is written (see
+    invalidate()); writes made by other processes only show up once the
+    tile expires. A tile being loaded makes other requests for it wait for
+    that load rather than run the same query.
+    '''
+
+    def __init__(self, ttl=5, zoom=14, max_tiles=64):
+        self.ttl = ttl
+        self.zoom = zoom
+        self.max_tiles = max_tiles
+        # (layer, variant, x, y): (expires, generation, rows)
+        self.entries = {}
+        # (layer, x, y) and layer: bumped on writes.
+        self.generations = {}
+        # layer: tiles written to in total.
+        self.writes = {}
+        self.loading = {}
+        self.lock = Lock()
+        self.swept = time.time()
+
+    def tiles(self, bounds):
+        # The tiles covering bounds, or None if there are too many to be worth it.
+        if self.ttl <= 0:
+            return None
+        return self.cover(bounds)
+
+    def cover(self, bounds):
+        west, north = tile_of(bounds[2], bounds[1], self.zoom)
+        east, south = tile_of(bounds[0], bounds[3], self.zoom)
+        if east < west or (east - west + 1) * (south - north + 1) > self.max_tiles:
+            return None
+        return [(x, y) for x in range(west, east + 1) for y in range(north, south + 1)]
+
+    def get(self, layer, variant, tile, load):
+        '''
+        Rows of one tile. load(bounds) returns the rows in (a little more
+        than) the tile's bounds; only those actually inside are kept.
+        '''
+        key = (layer, variant) + tile
+        with self.lock:
+            if time.time() - self.swept > 10 * self.ttl:
+                self._sweep()
+            rows = self._fresh(key)
+            if rows is not None:
+                return rows
+            loading = self.loading.setdefault(key, Lock())
+
+        with loading:
+            with self.lock:
+                rows = self._fresh(key)
+                if rows is not None:
+                    return rows
+                generation = self._generation(layer, tile)
+
+            # Slightly larger, so nothing on an edge is lost to rounding.
+            swLat, swLng, neLat, neLng = tile_bounds(tile[0], tile[1], self.zoom)
+            margin = 1e-6
+            try:
+                rows = [row for row in load((swLat - margin, swLng - margin, neLat + margin, neLng + margin))
+                        if tile_of(row['latitude'], row['longitude'], self.zoom) == tile]
+            except Exception:
+                with self.lock:
+                    self.loading.pop(key, None)
+                raise
+
+            with self.lock:
+                self.entries[key] = (time.time() + self.ttl, generation, rows)
+                self.loading.pop(key, None)
+            return rows
+
+    def version(self, layer, bounds=None):
+        '''
+        Changes whenever something in bounds (anywhere, without bounds) is
+        written to the layer. Writes are counted even with the cache off.
+        '''
+        tiles = self.cover(bounds) if bounds is not None else None
+        with self.lock:
+            if tiles is None:
+                return (self.generations.get(layer, 0), self.writes.get(layer, 0))
+            return (self.generations.get(layer, 0),) + tuple(self.generations.get((layer,) + t, 0) for t in tiles)
+
+    def invalidate(self, layer, rows):
+        tiles = set(tile_of(row['latitude'], row['longitude'], self.zoom) for row in rows)
+        with self.lock:
+            for tile in tiles:
+                key = (layer,) + tile
+                self.generations[key] = self.generations.get(key, 0) + 1
+            self.writes[layer] = self.writes.get(layer, 0) + len(tiles)
+
+    def invalidate_layer(self, layer):
+        with self.lock:
+            self.generations[layer] = self.generations.get(layer, 0) + 1
+
+    def _sweep(self):
+        # Drops the tiles nobody asked for since they expired.
+        now = time.time()
+        for key in [k for k, e in self.entries.items() if e[0] <= now]:
+            del self.entries[key]
+        self.swept = now
+
+    def _generation(self, layer, tile):
+        return (self.generations.get(layer, 0), self.generations.get((layer,) + tile, 0))
+
+    def _fresh(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, generation, rows = entry
+        if expires <= time.time() or generation != self._generation(key[0], key[2:]):
+            del self.entries[key]
+            return None
+        return rows
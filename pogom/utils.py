@@ -182,22 +182,46 @@ def get_args():
     parser.add_argument('--db-pass', help='Password for the database.')
     parser.add_argument('--db-host', help='IP or hostname for the database.')
     parser.add_argument('--db-port', help='Port for the database', type=int, default=3306)
-    parser.add_argument('--db-max_connections', help='Max connections (per thread) for the database.',
-                        type=int, default=5)
+    parser.add_argument('--db-max_connections', help='Max connections in total for the database (MySQL). Default: the db threads plus the read connections plus 10.',
+                        type=int, default=None)
+    parser.add_argument('--db-read-connections', help='Connections the search workers share for their database reads.',
+                        type=int, default=4)
+    parser.add_argument('--db-replica', action='append', default=[],
+                        help='host[:port] of a MySQL replica for the web server to read from. Can be given more than once.')
+    parser.add_argument('--db-replica-max-lag', help='Seconds a replica may be behind the primary and still be read from.',
+                        type=int, default=10)
     parser.add_argument('--db-threads', help='Number of db threads; increase if the db queue falls behind.',
                         type=int, default=1)
+    parser.add_argument('--db-batch-window', help='Milliseconds the db threads keep collecting queued updates before writing them in one transaction.',
+                        type=int, default=250)
+    parser.add_argument('--db-batch-size', help='Maximum number of rows the db threads write in one transaction.',
+                        type=int, default=1000)
+    parser.add_argument('--dead-letter-file', help='File the rows the database keeps refusing are written to.',
+                        default='dead_letters.jsonl')
+    parser.add_argument('--replay-dead-letters', help='Write the rows from the dead letter file to the database again on startup.',
+                        action='store_true', default=False)
+    parser.add_argument('--db-journal', help='Directory to journal queued database updates in, so they survive a restart. Disabled if not set.',
+                        default=None)
+    parser.add_argument('--db-journal-sync', help='Milliseconds between flushes of the database update journal to disk.',
+                        type=int, default=100)
     parser.add_argument('-wh', '--webhook', help='Define URL(s) to POST webhook information to.',
                         nargs='*', default=False, dest='webhooks')
     parser.add_argument('-gi', '--gym-info', help='Get all details about gyms (causes an additional API hit for every gym).',
                         action='store_true', default=False)
     parser.add_argument('--disable-clean', help='Disable clean db loop.',
                         action='store_true', default=False)
+    parser.add_argument('--disable-memory-index', help='Always query the database for active Pokemon and map updates instead of keeping them in memory. Use this when more than one instance writes to the same database.',
+                        action='store_true', default=False)
     parser.add_argument('-ctd', '--clean-timers-data', help='Set previous spawns as unvalid for new disappear_time prediction',
                         action='store_true', default=False)
     parser.add_argument('--webhook-updates-only', help='Only send updates (pokémon & lured pokéstops).',
                         action='store_true', default=False)
     parser.add_argument('--wh-threads', help='Number of webhook threads; increase if the webhook queue falls behind.',
                         type=int, default=1)
+    parser.add_argument('--tile-cache-ttl', help='Seconds the map tiles answering viewport queries are shared between clients before they are queried again. 0 to disable.',
+                        type=float, default=5)
+    parser.add_argument('-pu', '--push-updates', help='Push new Pokemon, lures and gym changes to the map as they are found instead of only polling for them.',
+                        action='store_true', default=False)
     parser.add_argument('--ssl-certificate', help='Path to SSL certificate file.')
     parser.add_argument('--ssl-privatekey', help='Path to SSL private key file.')
     parser.add_argument('-ps', '--print-status', action='store_true',
@@ -1,8 +1,11 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import calendar
 import logging
 import requests
+from base64 import b64encode
+from .events import EventBatch
 from .utils import get_args
 
 log = logging.getLogger(__name__)
@@ -29,14 +32,86 @@ def send_to_webhook(message_type, message):
             log.debug(e)
 
 
+def webhook_messages(args, item):
+    # The queue carries event batches from the bus and (type, message) tuples from everything else.
+    if not isinstance(item, EventBatch):
+        return [item]
+
+    messages = []
+    for event in item:
+        row = event.row
+        if event.kind == 'pokemon':
+            messages.append(('pokemon', {
+                'encounter_id': row['encounter_id'],
+                'spawnpoint_id': row['spawnpoint_id'],
+                'pokemon_id': row['pokemon_id'],
+                'latitude': row['latitude'],
+                'longitude': row['longitude'],
+                'disappear_time': calendar.timegm(row['disappear_time'].timetuple()),
+                'last_modified_time': event.timestamp_ms,
+                'time_until_hidden_ms': event.time_until_hidden_ms,
+                'individual_attack': row['individual_attack'],
+                'individual_defense': row['individual_defense'],
+                'individual_stamina': row['individual_stamina'],
+                'move_1': row['move_1'],
+                'move_2': row['move_2'],
+                'time_detail': row['time_detail']
+            }))
+
+        elif event.kind == 'pokestop':
+            l_e = None
+            if row['lure_expiration'] is not None:
+                l_e = calendar.timegm(row['lure_expiration'].timetuple())
+
+            if not args.webhook_updates_only:
+                # Send all pokéstops to webhooks.
+                messages.append(('pokestop', {
+                    'pokestop_id': b64encode(str(row['pokestop_id'])),
+                    'enabled': row['enabled'],
+                    'latitude': row['latitude'],
+                    'longitude': row['longitude'],
+                    'last_modified': event.timestamp_ms,
+                    'lure_expiration': l_e,
+                    'active_fort_modifier': row['active_fort_modifier']
+                }))
+            elif l_e is not None:
+                messages.append(('pokestop', {
+                    'pokestop_id': b64encode(str(row['pokestop_id'])),
+                    'enabled': row['enabled'],
+                    'latitude': row['latitude'],
+                    'longitude': row['longitude'],
+                    'last_modified_time': event.timestamp_ms,
+                    'lure_expiration': l_e,
+                    'active_fort_modifier': row['active_fort_modifier']
+                }))
+
+        elif event.kind == 'gym' and not args.webhook_updates_only:
+            messages.append(('gym', {
+                'gym_id': b64encode(str(row['gym_id'])),
+                'team_id': row['team_id'],
+                'guard_pokemon_id': row['guard_pokemon_id'],
+                'gym_points': row['gym_points'],
+                'enabled': row['enabled'],
+                'latitude': row['latitude'],
+                'longitude': row['longitude'],
+                'last_modified': event.timestamp_ms
+            }))
+
+        elif event.kind == 'gym_details':
+            messages.append(('gym_details', row))
+
+    return messages
+
+
 def wh_updater(args, q):
     # The forever loop.
     while True:
         try:
             # Loop the queue.
             while True:
-                whtype, message = q.get()
-                send_to_webhook(whtype, message)
+                item = q.get()
+                for whtype, message in webhook_messages(args, item):
+                    send_to_webhook(whtype, message)
                 if q.qsize() > 50:
                     log.warning("Webhook queue is > 50 (@%d); try increasing --wh-threads", q.qsize())
                 q.task_done()
@@ -23,8 +23,12 @@ from pogom.app import Pogom
 from pogom.utils import get_args, now
 
 from pogom.search import search_overseer_thread
-from pogom.models import init_database, create_tables, drop_tables, Pokemon, db_updater, clean_db_loop
+from pogom.models import init_database, create_tables, drop_tables, Pokemon, Spawnpoint, db_updater, clean_db_loop, \
+    change_log, replay_dead_letters
 from pogom.webhook import wh_updater
+from pogom.push import PushChannel
+from pogom.events import event_bus
+from pogom.journal import JournaledQueue
 
 from pogom.proxy import check_proxies
 
@@ -201,6 +205,16 @@ def main():
             os.remove(args.db)
     create_tables(db)
 
+    if args.replay_dead_letters:
+        replay_dead_letters()
+
+    # Only a writing instance sees every update, so only it can answer from memory.
+    # That includes the spawnpoint timings, which are kept current by whoever writes Pokemon.
+    if not args.only_server and not args.disable_memory_index:
+        Spawnpoint.load()
+        Pokemon.load_active()
+        change_log.enable()
+
     app.set_current_location(position)
 
     # Control the search status (running or not) across threads.
@@ -215,8 +229,13 @@ def main():
     new_location_queue = Queue()
     new_location_queue.put(position)
 
-    # DB Updates
-    db_updates_queue = Queue()
+    # DB Updates. Nothing may get lost on the way to the database, so a full buffer holds up the search workers.
+    # With a journal, whatever was left over from the last run is queued again right here.
+    if args.db_journal:
+        db_updates_queue = JournaledQueue(args.db_journal, maxsize=10000, sync_ms=args.db_journal_sync)
+    else:
+        db_updates_queue = Queue(10000)
+    event_bus.subscribe('db', policy='block', kinds=('pokemon', 'pokestop', 'gym', 'scanned'), queue=db_updates_queue)
 
     # Thread(s) to process database updates.
     for i in range(args.db_threads):
@@ -231,8 +250,12 @@ def main():
         t.daemon = True
         t.start()
 
-    # WH Updates.
-    wh_updates_queue = Queue()
+    # WH Updates. A slow webhook endpoint only costs it the oldest updates.
+    if args.webhooks:
+        wh_updates_queue = event_bus.subscribe('webhook', maxsize=1000, policy='drop_oldest',
+                                               kinds=('pokemon', 'pokestop', 'gym', 'gym_details')).queue
+    else:
+        wh_updates_queue = Queue()
 
     # Thread to process webhook updates.
     for i in range(args.wh_threads):
@@ -241,6 +264,15 @@ def main():
         t.daemon = True
         t.start()
 
+    # Map clients subscribed to live updates.
+    if args.push_updates:
+        push = PushChannel()
+        app.set_push_channel(push)
+        sub = event_bus.subscribe('push', maxsize=500, policy='drop_oldest', kinds=('pokemon', 'pokestop', 'gym'))
+        t = Thread(target=push.run, name='push-updater', args=(sub,))
+        t.daemon = True
+        t.start()
+
     if not args.only_server:
 
         # Check all proxies before continue so we know they are good.
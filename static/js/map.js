@@ -24,6 +24,8 @@ var languageLookupThreshold = 3
 var searchMarkerStyles
 
 var timestamp
+var seq
+var rawDataEtag
 var excludedPokemon = []
 var notifiedPokemon = []
 var notifiedRarity = []
@@ -57,6 +59,8 @@ var selectedStyle = 'light'
 
 var updateWorker
 var lastUpdateTime
+var pushSource
+var pushConnected = false
 
 var gymTypes = ['Uncontested', 'Mystic', 'Valor', 'Instinct']
 var gymPrestige = [2000, 4000, 8000, 12000, 16000, 20000, 30000, 40000, 50000]
@@ -176,6 +180,7 @@ function initMap () { // eslint-disable-line no-unused-vars
 
   map.setMapTypeId(Store.get('map_style'))
   map.addListener('idle', updateMap)
+  map.addListener('idle', connectPushUpdates)
 
   map.addListener('zoom_changed', function () {
     if (storeZoom === true) {
@@ -1010,6 +1015,7 @@ function loadRawData () {
     type: 'GET',
     data: {
       'timestamp': timestamp,
+      'seq': seq,
       'pokemon': loadPokemon,
       'lastpokemon': lastpokemon,
       'pokestops': loadPokestops,
@@ -1030,23 +1036,62 @@ function loadRawData () {
       'oNeLat': oNeLat,
       'oNeLng': oNeLng,
       'reids': String(reincludedPokemon),
-      'eids': String(excludedPokemon)
+      'eids': String(excludedPokemon),
+      // Columns leave out what we know from pokemon.json, so wait until it's loaded.
+      'format': $.isEmptyObject(idToPokemon) ? 'rows' : 'columnar'
     },
     dataType: 'json',
     cache: false,
-    beforeSend: function () {
+    beforeSend: function (xhr) {
       if (rawDataIsLoading) {
         return false
       } else {
         rawDataIsLoading = true
       }
+      if (rawDataEtag) {
+        xhr.setRequestHeader('If-None-Match', rawDataEtag)
+      }
     },
     complete: function () {
       rawDataIsLoading = false
     }
+  }).then(function (result, textStatus, xhr) {
+    if (textStatus === 'notmodified') {
+      return null
+    }
+    rawDataEtag = xhr.getResponseHeader('ETag')
+    $.each(['pokemons', 'pokestops', 'gyms', 'scanned', 'spawnpoints'], function (i, key) {
+      if (result[key] && !$.isArray(result[key]) && 'latitude' in result[key]) {
+        result[key] = fromColumns(result[key])
+      }
+    })
+    $.each(result.pokemons || [], function (i, item) {
+      if (!('pokemon_name' in item)) {
+        var pokemon = idToPokemon[item['pokemon_id']]
+        item['pokemon_name'] = pokemon['name']
+        item['pokemon_rarity'] = pokemon['rarity']
+        item['pokemon_types'] = pokemon['types']
+      }
+    })
+    return result
   })
 }
 
+function fromColumns (columns) {
+  // Parallel lists, one per field, back into one object per item.
+  var fields = Object.keys(columns)
+  var length = fields.length ? columns[fields[0]].length : 0
+  var items = new Array(length)
+  for (var i = 0; i < length; i++) {
+    var item = {}
+    for (var j = 0; j < fields.length; j++) {
+      item[fields[j]] = columns[fields[j]][i]
+    }
+    items[i] = item
+  }
+  return items
+}
+
 function processPokemons (i, item) {
   if (!Store.get('showPokemon')) {
     return false // in case the checkbox was unchecked in the meantime.
@@ -1215,6 +1260,11 @@ function updateSpawnPoints () {
 
 function updateMap () {
   loadRawData().done(function (result) {
+    if (!result) {
+      // Nothing changed since the last update, keep asking from there.
+      lastUpdateTime = Date.now()
+      return
+    }
     $.each(result.pokemons, processPokemons)
     $.each(result.pokestops, processPokestops)
     $.each(result.gyms, processGyms)
@@ -1253,10 +1303,68 @@ function updateMap () {
       reincludedPokemon = reids.filter(function (e) { return this.indexOf(e) < 0 }, reincludedPokemon)
     }
     timestamp = result.timestamp
+    seq = result.seq
     lastUpdateTime = Date.now()
   })
 }
 
+function connectPushUpdates () {
+  if (!pushUpdates || !window.EventSource) {
+    return
+  }
+  if (pushSource) {
+    pushSource.close()
+  }
+
+  // Only subscribe to what is on screen, reconnected whenever the map moves.
+  var bounds = map.getBounds()
+  var swPoint = bounds.getSouthWest()
+  var nePoint = bounds.getNorthEast()
+  pushSource = new EventSource('stream?' + $.param({
+    'swLat': swPoint.lat(),
+    'swLng': swPoint.lng(),
+    'neLat': nePoint.lat(),
+    'neLng': nePoint.lng()
+  }))
+  pushConnected = false
+
+  pushSource.onopen = function () {
+    pushConnected = true
+  }
+  pushSource.onerror = function () {
+    // EventSource reconnects by itself, poll as usual in the meantime.
+    pushConnected = false
+  }
+  pushSource.addEventListener('pokemon', function (e) {
+    processPokemons(0, JSON.parse(e.data))
+  })
+  pushSource.addEventListener('pokestop', function (e) {
+    processPokestops(0, JSON.parse(e.data))
+  })
+  pushSource.addEventListener('gym', function (e) {
+    var item = JSON.parse(e.data)
+    var current = mapData.gyms[item['gym_id']]
+    // Pushed gyms don't carry the name and members, new gyms come with the next poll.
+    if (current) {
+      processGyms(0, $.extend({}, current, item))
+    }
+  })
+  pushSource.addEventListener('reload', function () {
+    lastpokemon = false
+    lastpokestops = false
+    lastgyms = false
+    updateMap()
+  })
+}
+
+function pollMap () {
+  // With a live stream a slow poll is enough to pick up everything it doesn't carry.
+  if (pushConnected && Date.now() - lastUpdateTime < 60000) {
+    return
+  }
+  updateMap()
+}
+
 function drawScanPath (points) { // eslint-disable-line no-unused-vars
   var scanPathPoints = []
   $.each(points, function (idx, point) {
@@ -1968,7 +2076,7 @@ $(function () {
 
   // run interval timers to regularly update map and timediffs
   window.setInterval(updateLabelDiffTime, 1000)
-  window.setInterval(updateMap, 5000)
+  window.setInterval(pollMap, 5000)
   window.setInterval(updateGeoLocation, 1000)
 
   createUpdateWorker()
@@ -475,7 +475,17 @@ function appearanceTab (item) {
 
 function updateDetails () {
   loadDetails().done(function (result) {
-    $.each(result.appearances, processAppearance)
+    // Parallel lists, one index per spawnpoint.
+    var appearances = result.appearances
+    $.each(appearances['spawnpoint_id'], function (i, spawnpointId) {
+      processAppearance(i, {
+        'pokemon_id': appearances['pokemon_id'],
+        'spawnpoint_id': spawnpointId,
+        'latitude': appearances.latitude[i],
+        'longitude': appearances.longitude[i],
+        'count': appearances.count[i]
+      })
+    })
     if (heatmap) {
       heatmap.setMap(null)
     }